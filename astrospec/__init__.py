@@ -7,14 +7,23 @@
 # filename -> float np.array: raw_file_to_raw_image
 # filename -> uint8 np.array: raw_file_to_image
 # filename -> filename:       raw_file_to_file
+# filenames -> filenames:     raw_files_to_files (time-lapse, optionally registered)
+# filenames -> ranking:       rank_files (quick quality triage)
 
 from .video_reader import video_reader
-from .spectrum import find_edge, reduce_mean, fit_line_with_poly, frame_to_line, reconstruct
-from .shape_correction import detect_edge_points, filter_out_invalid_points, fit_ellipse, warp_frame
+from .spectrum import find_edge, find_illuminated, reduce_mean, find_lines, fit_line_with_poly, line_roi, line_sampler, sample_lines, frame_to_line, reconstruct
+from .shape_correction import detect_edge_points, find_edge_points, filter_out_invalid_points, fit_ellipse, warp_frame
 from .light_correction import correct_light
-from .postproc import normalize, color_map
+from .postproc import normalize, color_map, histogram_sketch, merge_sketches
+from .backend import set_backend, get_backend
+from .calibration import make_calibration, save_calibration, load_calibration
+from .registration import phase_correlation, register_sequence, rescale_transform, downsample
+from .quality import scan_quality, rank_files
+from .batch import run_batch, read_manifest
 from .utils import print
+import os
 import cv2
+import tempfile
 import numpy as np
 try:
     import matplotlib.pyplot as plt
@@ -22,40 +31,160 @@ except:
     pass
 from einops import rearrange, reduce, repeat
 
-def raw_file_to_file(file, output_file, raw = False, shifts = [0], correct_light_axis = 2, normalize_brightness = 1.0, color_map_name = 'orange-enhanced', verbose = 0):
+def raw_file_to_file(file, output_file, raw = False, shifts = [0], correct_light_axis = 2, normalize_brightness = 1.0, color_map_name = 'orange-enhanced', verbose = 0, lines = None, calibration = None):
     """
     raw_file_to_file 从ser文件重建图像，输出重建图像文件
     raw_file_to_file reconstruct image from raw video (ser file), write reconstructed, normalized, color mapped image to file(s)
 
     :param file: 输入ser文件路径 
     :param file: input file path
-    :param output_file: 输出文件路径。如果shifts有多个值，可通过参数{i:02d}、{shift:02d}指定文件名
-    :param output_file: output file path
+    :param output_file: 输出文件路径。如果shifts有多个值，可通过参数{i:02d}、{shift:02d}指定文件名；多条谱线时可用{line}指定，未指定时自动在扩展名前添加_line{line}
+    :param output_file: output file path, {i}, {shift} and {line} are formatted per image; for several lines _line{line} is appended before the extension if {line} is not given
     :param shifts: 波长偏移，例如：[-0.5, 0, 0.5]将输出3张偏离谱线中心指定距离的图片，单位为像素
     :param shifts: the wavelength offsets in pixels, e.g. [-0.5, 0, 0.5] returns 3 images in corresponding wavelengths
     :param color_map_name: 色彩映射，取值范围：orange-enhanced (默认), enhanced, linear (不进行任何映射)
     :param color_map_name: color map, values: orange-enhanced (default), enhanced, linear
     :param verbose: 0~3，输出调试信息
     :param verbose: 0~3，log information level
+    :param lines: 参见raw_file_to_raw_image
+    :param lines: see raw_file_to_raw_image
+    :param calibration: 参见raw_file_to_raw_image
+    :param calibration: see raw_file_to_raw_image
     :return: None
     """ 
-    imgs = raw_file_to_raw_image(file, shifts, correct_light_axis, verbose)
-
-    for i,img in enumerate(imgs):
-        _file = output_file.format(i=i, shift=shifts[i])
-        if verbose > 1:
-            print(f'write to {_file} (i={i}, shift={shifts[i]})')
-        if raw:
-            cv2.imencode(f'.{_file.split(".")[-1]}', np.clip(img, 0, 65535).astype(np.uint16))[1].tofile(_file)
+    imgs = raw_file_to_raw_image(file, shifts, correct_light_axis, verbose, lines = lines, calibration = calibration)
+    write_images(imgs, output_file, shifts, lines, raw, normalize_brightness, color_map_name, verbose)
+
+def write_images(imgs, output_file, shifts = [0], lines = None, raw = False, normalize_brightness = 1.0, color_map_name = 'orange-enhanced', verbose = 0, sketches = None):
+    # 输出raw_file_to_raw_image的结果，文件名规则参见raw_file_to_file；sketches: 每张图像（谱线、偏移）共享的直方图，用于亮度映射
+    if lines is None:
+        imgs = imgs[np.newaxis]
+    elif '{line' not in output_file:
+        stem, ext = os.path.splitext(output_file)
+        output_file = stem + '_line{line}' + ext
+
+    for line, line_imgs in enumerate(imgs):
+        for i,img in enumerate(line_imgs):
+            _file = output_file.format(i=i, shift=shifts[i], line=line)
+            if verbose > 1:
+                print(f'write to {_file} (i={i}, shift={shifts[i]}, line={line})')
+            if raw:
+                cv2.imencode(f'.{_file.split(".")[-1]}', np.clip(img, 0, 65535).astype(np.uint16))[1].tofile(_file)
+            else:
+                sketch = None if sketches is None else sketches[line * len(line_imgs) + i]
+                img = normalize(img, brightness=normalize_brightness, verbose=verbose, sketch=sketch).astype(int)
+                img = color_map(img, color_map_name)
+                if len(img.shape) == 3:
+                    img = img[:,:,::-1]
+
+                cv2.imencode(f'.{_file.split(".")[-1]}', img)[1].tofile(_file)
+
+def raw_files_to_files(files, output_files, raw = False, shifts = [0], correct_light_axis = 2, normalize_brightness = 1.0, color_map_name = 'orange-enhanced', verbose = 0, lines = None, register = False, n_jobs = 1, calibration = None, normalize_window = None):
+    """
+    raw_files_to_files 重建一组ser文件（例如延时序列），可选地把整个序列配准到同一位置和大小，并使用一致的亮度映射
+    raw_files_to_files reconstruct a sequence of ser files (e.g. a time-lapse), optionally registering the whole sequence to the same position and scale, and sharing one brightness mapping
+
+    :param files: 输入ser文件路径列表
+    :param files: input file paths
+    :param output_files: 输出文件路径列表，格式参见raw_file_to_file
+    :param output_files: output file paths, see raw_file_to_file for the format
+    :param register: 是否配准。配准变换与椭圆矫正合并，每张图像只重采样一次
+    :param register: whether to register the sequence. The transforms are folded into the ellipse warp, so each image is resampled only once
+    :param n_jobs: 配准的并行线程数
+    :param n_jobs: number of worker threads for the registration
+    :param calibration: 参见raw_file_to_raw_image
+    :param calibration: see raw_file_to_raw_image
+    :param normalize_window: 亮度映射。None：每张图像单独归一化；0：整个序列共享一个映射；n：前后各n张图像的滑动窗口共享映射。生成图像时统计直方图，不需要同时载入所有图像
+    :param normalize_window: brightness mapping. None: each image on its own; 0: one mapping for the whole sequence; n: a sliding window of n images on each side. The histograms are collected while the images are produced, without loading all images at once
+    :return: 成功处理的文件列表
+    :return: list of the processed files
+    """
+    calibration = load_calibration(calibration)
+    if raw:
+        normalize_window = None
+    if (not register and normalize_window is None) or len(files) == 0:
+        done = []
+        for file, output_file in zip(files, output_files):
+            try:
+                raw_file_to_file(file, output_file, raw, shifts, correct_light_axis, normalize_brightness, color_map_name, verbose, lines, calibration)
+                done.append(file)
+            except Exception as e:
+                print(f'{file}: {e}')
+        return done
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_files[0]))) as tmp:
+        if register:
+            results = _registered_raw_images(files, output_files, tmp, shifts, correct_light_axis, verbose, lines, n_jobs, calibration)
         else:
-            img = normalize(img, brightness=normalize_brightness, verbose=verbose).astype(int)
-            img = color_map(img, color_map_name)
-            if len(img.shape) == 3:
-                img = img[:,:,::-1]
+            results = _raw_images(files, output_files, shifts, correct_light_axis, verbose, lines, calibration)
+
+        if normalize_window is None:
+            done = []
+            for file, output_file, imgs in results:
+                write_images(imgs, output_file, shifts, lines, raw, normalize_brightness, color_map_name, verbose)
+                done.append(file)
+            return done
 
-            cv2.imencode(f'.{_file.split(".")[-1]}', _img)[1].tofile(_file)
+        # 生成图像时统计直方图并暂存图像，之后按窗口合并直方图，统一亮度映射
+        entries = []
+        for i, (file, output_file, imgs) in enumerate(results):
+            cache = os.path.join(tmp, f'result{i}.npy')
+            np.save(cache, imgs.astype(np.float32))
+            sketches = [histogram_sketch().add(img) for img in np.reshape(imgs, (-1,) + imgs.shape[-2:])]
+            entries.append((file, output_file, cache, sketches))
+        if normalize_window == 0:
+            shared = [merge_sketches(s) for s in zip(*[e[3] for e in entries])]
+        for i, (file, output_file, cache, _) in enumerate(entries):
+            if normalize_window == 0:
+                sketches = shared
+            else:
+                window = entries[max(0, i - normalize_window):i + normalize_window + 1]
+                sketches = [merge_sketches(s) for s in zip(*[e[3] for e in window])]
+            write_images(np.load(cache).astype(float), output_file, shifts, lines, raw, normalize_brightness, color_map_name, verbose, sketches)
+        return [e[0] for e in entries]
 
-def raw_file_to_image(file, shifts = [0], correct_light_axis = 2, normalize_brightness = 1.0, color_map_name = 'orange-enhanced', verbose = 0):
+def _raw_images(files, output_files, shifts = [0], correct_light_axis = 2, verbose = 0, lines = None, calibration = None):
+    # 逐个重建，返回 (file, output_file, raw_file_to_raw_image的结果) 的生成器，跳过失败的文件
+    for file, output_file in zip(files, output_files):
+        try:
+            yield file, output_file, raw_file_to_raw_image(file, shifts, correct_light_axis, verbose, lines = lines, calibration = calibration)
+        except Exception as e:
+            print(f'{file}: {e}')
+
+def _registered_raw_images(files, output_files, tmp, shifts = [0], correct_light_axis = 2, verbose = 0, lines = None, n_jobs = 1, calibration = None):
+    # 重建并配准整个序列，返回 (file, output_file, 图像) 的生成器；tmp: 暂存未变换图像的目录
+    preview_size = 256
+    entries = []
+    # 第一遍：重建，暂存未变换的图像，只保留降采样的预览用于配准
+    for i, (file, output_file) in enumerate(zip(files, output_files)):
+        try:
+            details = raw_file_to_raw_image(file, shifts, 0, verbose, return_details = True, lines = lines, calibration = calibration)
+        except Exception as e:
+            print(f'{file}: {e}')
+            continue
+        uncalib = details['uncalib']
+        cache = os.path.join(tmp, f'{i}.npy')
+        np.save(cache, uncalib.astype(np.float32))
+        preview = None
+        if details['ellipse'] is not None:
+            preview = downsample(np.reshape(details['result'], (-1,) + details['result'].shape[-2:])[0], preview_size)
+        entries.append((file, output_file, cache, uncalib.shape, details['ellipse'], preview))
+
+    # 配准（参考帧取序列中间，减小首尾的漂移）
+    registered = [e for e in entries if e[5] is not None]
+    transforms = {}
+    if len(registered) > 1:
+        Ms = register_sequence([e[5] for e in registered], ref = len(registered) // 2, size = preview_size, n_jobs = n_jobs, verbose = verbose)
+        for e, M in zip(registered, Ms):
+            transforms[e[0]] = rescale_transform(M, e[3][-2] / preview_size)
+
+    # 第二遍：椭圆矫正和配准合并为一次变换
+    for file, output_file, cache, shape, ellipse, _ in entries:
+        uncalib = np.load(cache).astype(float)
+        imgs = calibrate(np.reshape(uncalib, (-1,) + shape[-2:]), ellipse, correct_light_axis, transforms.get(file), verbose)
+        yield file, output_file, np.reshape(imgs, shape[:-2] + imgs.shape[-2:])
+
+def raw_file_to_image(file, shifts = [0], correct_light_axis = 2, normalize_brightness = 1.0, color_map_name = 'orange-enhanced', verbose = 0, lines = None, calibration = None):
     """
     raw_file_to_image 从ser文件重建图像，返回色彩映射后的重建图像，np.array(uint8)
     raw_file_to_image reconstruct image from raw video (ser file), return the reconstructed, normalized, color mapped image, np.array(uint8)
@@ -68,34 +197,48 @@ def raw_file_to_image(file, shifts = [0], correct_light_axis = 2, normalize_brig
     :param color_map_name: color map, values: orange-enhanced (default), enhanced, linear
     :param verbose: 0~3，输出调试信息
     :param verbose: 0~3，log information level
-    :return: 色彩映射后的重建图像，np.array(uint8)
-    :return: reconstructed, normalized, color mapped image, np.array(uint8)
+    :param lines: 参见raw_file_to_raw_image
+    :param lines: see raw_file_to_raw_image
+    :param calibration: 参见raw_file_to_raw_image
+    :param calibration: see raw_file_to_raw_image
+    :return: 色彩映射后的重建图像，np.array(uint8)；多条谱线时按谱线分组
+    :return: reconstructed, normalized, color mapped image, np.array(uint8); grouped per line for several lines
     """ 
-    imgs = raw_file_to_raw_image(file, shifts, correct_light_axis, verbose)
+    imgs = raw_file_to_raw_image(file, shifts, correct_light_axis, verbose, lines = lines, calibration = calibration)
+    if lines is not None:
+        return [[color_map(normalize(img, brightness=normalize_brightness, verbose=verbose).astype(int), color_map_name) for img in line_imgs] for line_imgs in imgs]
     imgs = [normalize(img, brightness=normalize_brightness, verbose=verbose).astype(int) for img in imgs]
     imgs = [color_map(img, color_map_name) for img in imgs]
     return imgs
 
-def raw_file_to_raw_image(file, shifts = [0], correct_light_axis = 2, verbose = 0, return_details = False):
+def raw_file_to_raw_image(file, shifts = [0], correct_light_axis = 2, verbose = 0, return_details = False, lines = None, calibration = None):
     """
     raw_file_to_raw_image 从ser文件重建图像，返回原始值空间的重建图像，np.array(float64)
     raw_file_to_raw_image reconstruct image from raw video (ser file), return the reconstructed image, np.array(float64)
 
-    :param file: 输入ser文件路径 
-    :param file: input file path
+    :param file: 输入ser/avi文件路径，或其他帧来源：文件对象、内存缓冲区、np.array (n, h, w)、帧的迭代器，参见video_reader.open
+    :param file: input ser/avi file path, or another frame source: file-like object, buffer, np.array (n, h, w), iterable of frames, see video_reader.open
     :param shifts: 波长偏移，例如：[-0.5, 0, 0.5]将输出3张偏离谱线中心指定距离的图片，单位为像素
     :param shifts: the wavelength offsets in pixels, e.g. [-0.5, 0, 0.5] returns 3 images in corresponding wavelengths
     :param verbose: 0~3，输出调试信息
     :param verbose: 0~3，log information level
     :param return_details: 是否返回重建过程中间步骤数据
     :param return_details: whether to return data from intermediate steps
-    :return: 原始值空间的重建图像，np.array(float64)
-    :return: reconstructed image, np.array(float64)
+    :param lines: 多谱线提取。None：只提取最深的一条谱线；整数n：在平均帧中自动寻找n条谱线；[(x1, x2), ...]：每条谱线所在的列窗口
+    :param lines: multi-line extraction. None: the deepest line only; int n: detect n lines in the mean frame; [(x1, x2), ...]: column window of each line
+    :param calibration: 暗场、平场校准，make_calibration的结果或保存的校准文件路径；在读取帧时只校准被采样的像素
+    :param calibration: dark and flat calibration, the result of make_calibration or the path of a saved calibration file; applied while reading, only to the sampled pixels
+    :return: 原始值空间的重建图像，np.array(float64)，形状为(len(shifts), h, w)；指定lines时为(n_lines, len(shifts), h, w)
+    :return: reconstructed image, np.array(float64), shape (len(shifts), h, w), or (n_lines, len(shifts), h, w) if lines is given
     """ 
-    reader = video_reader.from_file(file, auto_rotate_vertical=True)
+    reader = video_reader.open(file, auto_rotate_vertical=True)
+    calibration = load_calibration(calibration)
+    if verbose > 0 and len(reader.dropped_frames()) > 0:
+        # 丢帧处扫描不连续，日面会变形
+        print(f'dropped frames (after frame, count): {reader.dropped_frames()}')
 
     # 全局平均帧
-    img_mean = reduce_mean(reader)
+    img_mean, img_max = reduce_mean(reader, calibration, return_max = True)
     curve = reduce(img_mean.astype(float), f'h w -> h', 'mean')
     # y1, y2 = 0, reader.height
     y1, y2 = find_edge(curve, verbose = verbose)
@@ -105,10 +248,21 @@ def raw_file_to_raw_image(file, shifts = [0], correct_light_axis = 2, verbose =
         plt.show()
 
     # 谱线位置拟合
-    fit = fit_line_with_poly(img_mean, y1, y2, verbose = verbose)
+    if lines is None:
+        windows = [None]
+    elif isinstance(lines, int):
+        windows = find_lines(img_mean, y1, y2, lines, verbose = verbose)
+    else:
+        windows = lines
+    fits = np.array([fit_line_with_poly(img_mean, y1, y2, window = window, verbose = verbose) for window in windows])
 
-    # 重建
-    imgs = reconstruct(reader, fit, shifts = shifts)
+    # 重建，所有谱线与日面边缘检测用的偏移在同一次读取中完成，只读取任意一帧中谱线处有光的行和谱线附近的列
+    shifts_all = list(shifts) + [10]
+    imgs = reconstruct(reader, fits, shifts = shifts_all, calibration = calibration, rows = find_illuminated(img_max, fits, shifts_all))
+    raw_lines = imgs[0, -1].T
+    imgs = imgs[:, :-1]
+    n_lines = imgs.shape[0]
+    imgs = np.reshape(imgs, (-1,) + imgs.shape[2:])
     if verbose > 0:
         print(imgs.shape)
     if verbose > 1:
@@ -116,7 +270,7 @@ def raw_file_to_raw_image(file, shifts = [0], correct_light_axis = 2, verbose =
         plt.show()
     
     # 椭圆拟合
-    edge_points, raw_lines = detect_edge_points(reader, fit, verbose=verbose)
+    edge_points = find_edge_points(raw_lines, verbose=verbose)
     edge_points = filter_out_invalid_points(edge_points, 8)
     ellipse = None
     try:
@@ -125,6 +279,36 @@ def raw_file_to_raw_image(file, shifts = [0], correct_light_axis = 2, verbose =
         import traceback
         print(f'{traceback.format_exc()}')
 
+    ret = calibrate(imgs, ellipse, correct_light_axis, verbose = verbose)
+
+    if lines is not None:
+        ret = np.reshape(ret, (n_lines, len(shifts)) + ret.shape[1:])
+        imgs = np.reshape(imgs, (n_lines, len(shifts)) + imgs.shape[1:])
+    
+    if return_details:
+        return {
+            'result': ret,
+            'uncalib': imgs,
+            'edge_points': edge_points,
+            'ellipse': ellipse,
+            'windows': windows,
+            'fits': fits,
+        }
+    return ret
+
+def calibrate(imgs, ellipse, correct_light_axis = 2, transform = None, verbose = 0):
+    """
+    calibrate 对重建结果进行叠加、椭圆矫正（可合并额外的变换）和杂散光矫正
+    calibrate stack, warp (ellipse correction, optionally with an extra transform folded in) and remove stray light from reconstructed images
+
+    :param imgs: reconstruct的结果，(n, h, frames)
+    :param imgs: output of reconstruct, (n, h, frames)
+    :param ellipse: fit_ellipse的结果，None时不变换
+    :param ellipse: output of fit_ellipse, no warp if None
+    :param transform: 额外的3x3变换，例如register_sequence的结果
+    :param transform: extra 3x3 transform, e.g. from register_sequence
+    :return: np.array(float64)
+    """
     ret = []
     sz = imgs.shape[1]
     # 图像变换
@@ -142,19 +326,11 @@ def raw_file_to_raw_image(file, shifts = [0], correct_light_axis = 2, verbose =
 
         # 图像变换
         if ellipse is not None:
-            img = warp_frame(ellipse, img, sz)
+            img = warp_frame(ellipse, img, sz, transform = transform)
         
         # 杂散光矫正
         if correct_light_axis > 0:
             img = correct_light(img, n_axis=correct_light_axis, verbose=verbose)
         
         ret.append(img)
-    
-    if return_details:
-        return {
-            'result': np.array(ret),
-            'uncalib': imgs,
-            'edge_points': edge_points,
-            'ellipse': ellipse,
-        }
     return np.array(ret)
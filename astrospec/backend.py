@@ -0,0 +1,183 @@
+"""
+@author: Harold Liang (https://lcsky.org)
+
+optional compiled backend for the per-pixel hot loops, the pure numpy implementations in spectrum, shape_correction and light_correction are the reference
+
+set_backend('numba' | 'numpy' | 'auto'), or the environment variable ASTROSPEC_BACKEND, 'auto' uses numba if it is installed
+"""
+
+import os
+import numpy as np
+try:
+    import numba
+    from numba import njit, prange
+except:
+    numba = None
+
+_backend = None
+
+def set_backend(name = 'auto'):
+    global _backend
+    if name == 'auto':
+        name = 'numpy' if numba is None else 'numba'
+    if name not in ('numpy', 'numba'):
+        raise Exception(f'unknown backend ({name})')
+    if name == 'numba' and numba is None:
+        raise Exception('numba is not installed')
+    _backend = name
+
+def get_backend():
+    if _backend is None:
+        set_backend(os.environ.get('ASTROSPEC_BACKEND', 'auto'))
+    return _backend
+
+def use_numba():
+    return get_backend() == 'numba'
+
+if numba is not None:
+    @njit(parallel=True, cache=True)
+    def _sample_lines_block(frames, idx_l, idx_r, left_weights, right_weights, offset, out):
+        n = frames.shape[0]
+        frames = frames.reshape(n, -1)
+        s, ih = idx_l.shape
+        for k in prange(n):
+            img = frames[k]
+            for j in range(s):
+                for y in range(ih):
+                    out[k, j, y] = img[idx_l[j, y]] * left_weights[j, y] + img[idx_r[j, y]] * right_weights[j, y] - offset[j, y]
+
+    @njit(cache=True, error_model='numpy')
+    def _cross_points(arr, thd, ret):
+        # 与np.argmax相同：没有穿越点时取0
+        n = len(arr)
+        up, down = 0, 0
+        for i in range(n - 1):
+            if arr[i] <= thd and arr[i+1] > thd:
+                up = i
+                break
+        for i in range(n - 1):
+            if arr[i] >= thd and arr[i+1] < thd:
+                down = i
+                break
+        a, b = arr[up], arr[up+1]
+        ret[0] = up + (thd-a)/(b-a)
+        a, b = arr[down], arr[down+1]
+        ret[1] = down + (thd-a)/(b-a)
+
+    @njit(parallel=True, cache=True, error_model='numpy')
+    def _edge_points(raw_lines, lines, line_maxval):
+        for k in prange(raw_lines.shape[0]):
+            line = raw_lines[k]
+            _min = np.min(line)
+            thd_val = np.max(line) - _min
+            line_maxval[k] = thd_val
+            _cross_points(line, _min + thd_val/4, lines[k])
+
+    @njit(cache=True)
+    def _find_rising(arr):
+        # 前缀和/平方和统计，只在可能存在离群点时才扫描整个前缀
+        arr = arr.copy()
+        n = len(arr)
+        s, s2, cnt = 0.0, 0.0, 0
+        lo, hi = np.inf, -np.inf
+        for i in range(n // 2):
+            if i >= 3:
+                if cnt >= 3:
+                    mean = s / cnt
+                    std = np.sqrt(max(s2 / cnt - mean * mean, 0.0))
+                    if hi - mean > std * 3 or mean - lo > std * 3:
+                        # 去除离群点，重新统计
+                        s, s2, cnt = 0.0, 0.0, 0
+                        lo, hi = np.inf, -np.inf
+                        for j in range(i):
+                            v = arr[j]
+                            if np.isnan(v):
+                                continue
+                            if abs(v - mean) > std * 3:
+                                arr[j] = np.nan
+                                continue
+                            s += v
+                            s2 += v * v
+                            cnt += 1
+                            lo = min(lo, v)
+                            hi = max(hi, v)
+                    if cnt >= 3:
+                        mean = s / cnt
+                        std = max(1.0, np.sqrt(max(s2 / cnt - mean * mean, 0.0)))
+                        if arr[i] > mean + std * 6:
+                            return i
+            v = arr[i]
+            if not np.isnan(v):
+                s += v
+                s2 += v * v
+                cnt += 1
+                lo = min(lo, v)
+                hi = max(hi, v)
+        return -1
+
+    @njit(parallel=True, cache=True, error_model='numpy')
+    def _fit_parabola_rows(img, x_ymins_int, y1, y2, wx1, wx2, n_fit_pixels, out):
+        # 逐行最小二乘拟合二次曲线，返回极小值位置；x以窗口中心为原点，保证数值稳定
+        for k in prange(y2 - y1):
+            y = y1 + k
+            x1 = max(wx1, x_ymins_int[y] - n_fit_pixels)
+            x2 = min(wx2, x_ymins_int[y] + n_fit_pixels + 1)
+            xc = (x1 + x2 - 1) / 2
+            m = np.zeros((3, 4))
+            vmax = 0.0
+            for x in range(x1, x2):
+                dx = x - xc
+                v = float(img[y, x])
+                vmax = max(vmax, abs(v))
+                p = (dx*dx, dx, 1.0)
+                for r in range(3):
+                    for c in range(3):
+                        m[r, c] += p[r] * p[c]
+                    m[r, 3] += p[r] * v
+            # 高斯消元
+            for c in range(3):
+                piv = c
+                for r in range(c + 1, 3):
+                    if abs(m[r, c]) > abs(m[piv, c]):
+                        piv = r
+                for j in range(4):
+                    m[c, j], m[piv, j] = m[piv, j], m[c, j]
+                for r in range(3):
+                    if r != c and m[c, c] != 0:
+                        f = m[r, c] / m[c, c]
+                        for j in range(4):
+                            m[r, j] -= f * m[c, j]
+            a = m[0, 3] / m[0, 0]
+            b = m[1, 3] / m[1, 1]
+            # 平坦或共线的行没有极值，取窗口中心（与参考实现一致）
+            if abs(a) <= 1e-9 * (vmax + 1):
+                out[k] = xc
+            else:
+                out[k] = xc - b / (2*a)
+
+def sample_lines_block(frames, sampler, out):
+    idx_l, idx_r, left_weights, right_weights, offset = sampler
+    _sample_lines_block(np.ascontiguousarray(frames), idx_l, idx_r, left_weights, right_weights, offset, out)
+
+def edge_points(raw_lines):
+    raw_lines = np.ascontiguousarray(raw_lines, dtype=float)
+    lines = np.empty((raw_lines.shape[0], 2))
+    line_maxval = np.empty(raw_lines.shape[0])
+    _edge_points(raw_lines, lines, line_maxval)
+    return lines, line_maxval
+
+def cross_points(arr, thd):
+    ret = np.empty(2)
+    _cross_points(np.ascontiguousarray(arr, dtype=float), float(thd), ret)
+    return list(ret)
+
+def find_rising(arr):
+    i = _find_rising(np.ascontiguousarray(arr, dtype=float))
+    if i < 0:
+        raise(Exception('no rising edge detected!'))
+    return i
+
+def fit_parabola_rows(img, x_ymins_int, y1, y2, wx1, wx2, n_fit_pixels):
+    out = np.empty(y2 - y1)
+    _fit_parabola_rows(np.ascontiguousarray(img), np.ascontiguousarray(x_ymins_int, dtype=np.int64), y1, y2, wx1, wx2, n_fit_pixels, out)
+    return out
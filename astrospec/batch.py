@@ -0,0 +1,197 @@
+"""
+@author: Harold Liang (https://lcsky.org)
+
+batch runs shared by several processes or machines working on the same (network) folder: each input file is claimed by creating a claim file atomically, the claim is a lease renewed while the file is processed, completion is recorded in a manifest (one record per file), and claims whose lease expired (e.g. the worker crashed) are taken over by the other workers
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from .utils import print
+
+def parse_shard(shard):
+    # "i/n" -> (i, n)
+    if shard is None or isinstance(shard, tuple):
+        return shard
+    i, n = (int(x) for x in shard.split('/'))
+    if n <= 0 or not 0 <= i < n:
+        raise Exception(f'invalid shard ({shard}), expected i/n with 0 <= i < n')
+    return i, n
+
+def read_manifest(work_dir):
+    # 所有已完成（或失败）文件的记录 {文件名: 记录}
+    ret = {}
+    if not os.path.isdir(work_dir):
+        return ret
+    for name in os.listdir(work_dir):
+        if name.endswith('.done'):
+            try:
+                with open(os.path.join(work_dir, name)) as f:
+                    ret[name[:-len('.done')]] = json.load(f)
+            except (OSError, ValueError):
+                # 正在被替换
+                pass
+    return ret
+
+def _finished(record, start):
+    # 完成的文件，以及本次运行开始后失败的文件（避免每个进程都重试一遍）；更早失败的文件重试
+    return record.get('status') == 'done' or record.get('end', 0) >= start
+
+def _write_atomic(path, data):
+    tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+class claim:
+    # 认领文件：O_EXCL创建保证只有一个进程成功；处理期间后台线程定期更新修改时间（租约）
+    def __init__(self, path, lease = 600):
+        self.path = path
+        self.lease = lease
+        self.token = uuid.uuid4().hex
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        self._take_over_stale()
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time(), 'token': self.token}, f)
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+        self._thread.start()
+        return True
+
+    def _take_over_stale(self):
+        # 租约过期的认领改名移走，只有一个进程能改名成功；改名后再检查一次，期间可能已被其他进程重新认领
+        try:
+            if time.time() - os.stat(self.path).st_mtime < self.lease:
+                return
+            stale = f'{self.path}.{self.token}.stale'
+            os.rename(self.path, stale)
+            fresh = time.time() - os.stat(stale).st_mtime < self.lease
+        except FileNotFoundError:
+            return
+        if fresh:
+            self._put_back(stale)
+            return
+        print(f'take over stale claim: {self.path}')
+        os.remove(stale)
+
+    def _put_back(self, stale):
+        # 放回原处，不覆盖期间新建的认领
+        try:
+            os.link(stale, self.path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # 不支持硬链接的文件系统
+            try:
+                with open(stale, 'rb') as f:
+                    data = f.read()
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+            except OSError:
+                pass
+        os.remove(stale)
+
+    @staticmethod
+    def _read_token(path):
+        try:
+            with open(path) as f:
+                return json.load(f).get('token')
+        except (OSError, ValueError):
+            return None
+
+    def _renew(self):
+        while not self._stop.wait(self.lease / 4):
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    def release(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            if self._read_token(self.path) == self.token:
+                os.remove(self.path)
+        except OSError:
+            pass
+
+def run_batch(files, output_files, process, work_dir, lease = 600, shard = None, wait = True, poll = None, verbose = 0):
+    """
+    run_batch 多个进程或多台机器处理同一目录时分配任务：认领文件后处理，完成后写入清单；其他进程的认领租约过期后会被重试，失败的文件在下次运行时重试
+    run_batch share a batch between several processes or machines working on the same folder: claim a file, process it, record it in the manifest; claims whose lease expired are retried by the other workers, failed files are retried in the next run
+
+    :param files: 输入文件列表
+    :param files: input files
+    :param output_files: 输出文件列表
+    :param output_files: output files
+    :param process: process(file, output_file)，处理一个文件，出错时抛出异常
+    :param process: process(file, output_file), processes one file, raises on errors
+    :param work_dir: 认领文件和清单所在的目录，所有进程必须相同
+    :param work_dir: folder of the claims and the manifest, the same for all workers
+    :param lease: 认领的租约（秒），处理期间自动续约；超过该时间未续约的认领视为失效
+    :param lease: lease of a claim in seconds, renewed while processing; claims not renewed for longer are stale
+    :param shard: (i, n) 或 "i/n"，只处理排序后的第i::n个文件
+    :param shard: (i, n) or "i/n", only process the files i::n (sorted)
+    :param wait: 剩余文件都被其他进程认领时，是否等待它们完成（或租约过期后重试）
+    :param wait: whether to wait while the remaining files are claimed by other workers, retrying them if their lease expires
+    :param poll: 等待时的检查间隔（秒），默认为lease的1/4
+    :param poll: interval in seconds between checks while waiting, lease / 4 by default
+    :return: 本进程处理完成的文件列表
+    :return: list of the files processed by this worker
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    shard = parse_shard(shard)
+    pairs = sorted(zip(files, output_files))
+    if shard is not None:
+        pairs = pairs[shard[0]::shard[1]]
+    poll = lease / 4 if poll is None else poll
+
+    start = time.time()
+    done = []
+    while True:
+        finished = {name for name, record in read_manifest(work_dir).items() if _finished(record, start)}
+        pending = [(file, output_file) for file, output_file in pairs if os.path.basename(file) not in finished]
+        if len(pending) == 0:
+            break
+        processed = False
+        for file, output_file in pending:
+            name = os.path.basename(file)
+            c = claim(os.path.join(work_dir, name + '.claim'), lease)
+            if not c.acquire():
+                continue
+            try:
+                # 认领前可能已被其他进程完成
+                if _finished(read_manifest(work_dir).get(name, {}), start):
+                    continue
+                record = {'file': file, 'output_file': output_file, 'host': socket.gethostname(), 'pid': os.getpid(), 'start': time.time()}
+                try:
+                    process(file, output_file)
+                    record['status'] = 'done'
+                    done.append(file)
+                except Exception as e:
+                    print(f'{file}: {e}')
+                    record['status'] = 'failed'
+                    record['error'] = str(e)
+                record['end'] = time.time()
+                _write_atomic(os.path.join(work_dir, name + '.done'), record)
+                processed = True
+                if verbose > 0:
+                    print(f'{record["status"]}: {file} ({record["end"] - record["start"]:.1f}s)')
+            finally:
+                c.release()
+        if not processed:
+            if not wait:
+                break
+            time.sleep(poll)
+    return done
@@ -0,0 +1,61 @@
+"""
+@author: Harold Liang (https://lcsky.org)
+
+dark and flat calibration, the master frames are applied on the fly: line_sampler folds them into its weights, so only the sampled pixels are corrected
+"""
+
+import numpy as np
+from .video_reader import video_reader
+from .spectrum import reduce_mean
+from .utils import print
+
+def master_frame(file):
+    # 平均帧（传感器原始方向）
+    reader = video_reader.open(file, auto_rotate_vertical=False)
+    return reduce_mean(reader, dtype = 'float32')
+
+def make_calibration(dark = None, flat = None, flat_dark = None, output_file = None, verbose = 0):
+    """
+    make_calibration 由暗场、平场ser文件生成校准数据，可保存为文件以便重复使用
+    make_calibration build the calibration from dark and flat ser files, optionally saved to a file for reuse
+
+    :param dark: 暗场文件（与拍摄文件相同曝光）
+    :param dark: dark file, same exposure as the scans
+    :param flat: 平场文件。平场沿狭缝方向归一化，保留光谱本身的强度分布
+    :param flat: flat file. The flat is normalized along the slit, so the spectral profile itself is kept
+    :param flat_dark: 平场的暗场文件，默认使用dark
+    :param flat_dark: dark file for the flat, dark by default
+    :param output_file: 保存路径(.npz)
+    :param output_file: path to save the calibration to (.npz)
+    :return: {'dark': np.array or None, 'gain': np.array or None}
+    """
+    calibration = {'dark': None, 'gain': None}
+    if dark is not None:
+        calibration['dark'] = master_frame(dark)
+    if flat is not None:
+        flat = master_frame(flat)
+        if flat_dark is not None:
+            flat = flat - master_frame(flat_dark)
+        elif calibration['dark'] is not None:
+            flat = flat - calibration['dark']
+        # 狭缝方向为长边，沿狭缝求平均得到光谱强度分布
+        profile = np.mean(flat, axis=1 if flat.shape[1] > flat.shape[0] else 0, keepdims=True)
+        valid = flat > np.max(flat) * 0.01
+        gain = np.ones(flat.shape, dtype=np.float32)
+        gain[valid] = (np.broadcast_to(profile, flat.shape)[valid] / flat[valid])
+        calibration['gain'] = gain
+        if verbose > 0:
+            print(f'gain: min = {np.min(gain):.3f}, max = {np.max(gain):.3f}')
+    if output_file is not None:
+        save_calibration(output_file, calibration)
+    return calibration
+
+def save_calibration(file, calibration):
+    np.savez(file, **{k: v for k, v in calibration.items() if v is not None})
+
+def load_calibration(calibration):
+    # 校准文件路径，或已加载的校准数据
+    if calibration is None or isinstance(calibration, dict):
+        return calibration
+    with np.load(calibration) as data:
+        return {'dark': data['dark'] if 'dark' in data else None, 'gain': data['gain'] if 'gain' in data else None}
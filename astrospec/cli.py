@@ -7,7 +7,7 @@ import argparse
 from tqdm import tqdm
 from glob import glob
 from pathlib import Path
-from astrospec import raw_file_to_file
+from astrospec import raw_file_to_file, raw_files_to_files, rank_files, run_batch, set_backend, make_calibration, load_calibration
 from .utils import print
 
 def files_to_mp4(folder, output_folder, frame_rate=30):
@@ -15,33 +15,73 @@ def files_to_mp4(folder, output_folder, frame_rate=30):
         ffmpeg -framerate {frame_rate} -pattern_type glob -i '{folder}/*.png' -c:v libx264 -pix_fmt yuv420p '{output_folder}/output.mp4' -y
     """)
 
-def process_folder(input_folder, output_folder, raw, correct_light_axis, normalize_brightness, color_map_name, output_video, verbose, **kwargs):
+def list_inputs(input_folder):
+    return sorted(glob(os.path.join(input_folder, '*.[sS][eE][rR]')) + glob(os.path.join(input_folder, '*.[aA][vV][iI]')))
+
+def parse_lines(lines):
+    # "2" -> 自动寻找2条谱线, "40:80,150:190" -> 列窗口
+    if lines is None or ':' not in lines:
+        return None if lines is None else int(lines)
+    return [tuple(int(x) for x in window.split(':')) for window in lines.split(',')]
+
+def process_folder(input_folder, output_folder, raw, correct_light_axis, normalize_brightness, color_map_name, output_video, verbose, lines = None, register = False, jobs = 1, calibration = None, normalize_window = None, batch = False, shard = None, lease = 600, **kwargs):
     output_path = os.path.join(input_folder, output_folder)
     os.makedirs(output_path, exist_ok=True)
-    for i, file in enumerate(tqdm(sorted(glob(os.path.join(input_folder, '*.[sS][eE][rR]'))), ncols=80)):
+    if (batch or shard is not None) and (register or normalize_window is not None):
+        raise Exception('--batch/--shard processes the files independently, it cannot be combined with -r or -nw')
+    if register or normalize_window is not None:
+        # 配准、共享亮度映射需要整个序列，不跳过已有的输出
+        files = list_inputs(input_folder)
+        files_out = [os.path.join(output_path, Path(file).stem + '.png') for file in files]
+        raw_files_to_files(files, files_out, raw = raw, correct_light_axis = correct_light_axis, normalize_brightness = normalize_brightness, color_map_name = color_map_name, verbose = verbose, lines = parse_lines(lines), register = register, n_jobs = jobs, calibration = calibration, normalize_window = normalize_window)
+        if output_video:
+            files_to_mp4(output_path, os.path.dirname(output_path))
+        return
+
+    if batch or shard is not None:
+        # 多个进程/机器共享同一目录：认领文件后处理，完成后记录到清单，不依赖输出文件是否存在
+        files = list_inputs(input_folder)
+        files_out = [os.path.join(output_path, Path(file).stem + '.png') for file in files]
+        process = lambda file, file_out: raw_file_to_file(file, file_out, raw = raw, correct_light_axis = correct_light_axis, normalize_brightness = normalize_brightness, color_map_name = color_map_name, verbose = verbose, lines = parse_lines(lines), calibration = calibration)
+        run_batch(files, files_out, process, os.path.join(output_path, '.batch'), lease = lease, shard = shard, verbose = max(verbose, 1))
+        if output_video:
+            files_to_mp4(output_path, os.path.dirname(output_path))
+        return
+
+    for i, file in enumerate(tqdm(list_inputs(input_folder), ncols=80)):
         file_out = os.path.join(output_path, Path(file).stem + '.png')
-        if os.path.isfile(file_out):
+        # 多谱线时以第一条谱线的输出为准
+        file_check = file_out if lines is None else os.path.join(output_path, Path(file).stem + '_line0.png')
+        if os.path.isfile(file_check):
             print(f'skipped: {file}, output file exists')
             continue
         # print(i, file, file_out)
         try:
-            raw_file_to_file(file, file_out, raw = raw, correct_light_axis = correct_light_axis, normalize_brightness = normalize_brightness, color_map_name = color_map_name, verbose = verbose)
+            raw_file_to_file(file, file_out, raw = raw, correct_light_axis = correct_light_axis, normalize_brightness = normalize_brightness, color_map_name = color_map_name, verbose = verbose, lines = parse_lines(lines), calibration = calibration)
         except Exception as e:
             print(e)
     
     if output_video:
         files_to_mp4(output_path, os.path.dirname(output_path))
 
-def process_single_file(input_file, output_folder, raw, correct_light_axis, normalize_brightness, color_map_name, verbose, **kwargs):
+def process_single_file(input_file, output_folder, raw, correct_light_axis, normalize_brightness, color_map_name, verbose, lines = None, calibration = None, **kwargs):
     output_path = os.path.join(os.path.dirname(input_file), output_folder)
     os.makedirs(output_path, exist_ok=True)
     file_out = os.path.join(output_path, Path(input_file).stem + '.png')
-    raw_file_to_file(input_file, file_out, raw = raw, correct_light_axis = correct_light_axis, normalize_brightness = normalize_brightness, color_map_name = color_map_name, verbose = verbose)
+    raw_file_to_file(input_file, file_out, raw = raw, correct_light_axis = correct_light_axis, normalize_brightness = normalize_brightness, color_map_name = color_map_name, verbose = verbose, lines = parse_lines(lines), calibration = calibration)
+
+def rank(files, rank_frames = 128, verbose = 0, calibration = None, **kwargs):
+    results = rank_files(files, n_frames = rank_frames, calibration = calibration, verbose = verbose)
+    width = max([len(os.path.basename(file)) for file, _ in results] + [4])
+    print(f'{"rank":>4}  {"file":<{width}}  {"sharpness":>9}  {"residual":>8}  {"coverage":>8}  {"dropped":>7}  {"time":>6}')
+    for i, (file, r) in enumerate(results):
+        print(f'{i+1:>4}  {os.path.basename(file):<{width}}  {r["sharpness"]:>9.4f}  {r["residual"]:>8.4f}  {r["coverage"]:>8.3f}  {r["dropped"]:>7}  {r["time"]:>5.2f}s')
 
 def main():
     parser = argparse.ArgumentParser(description='astronomy spectroheliograph reconstruct tool')
-    parser.add_argument('-i', '--input_file', help='Path to the input raw video file(.SER file)', default=None)
-    parser.add_argument('-f', '--input_folder', help='Folder of the input raw video file(.SER file)', default=None)
+    parser.add_argument('mode', nargs='?', choices=['reconstruct', 'rank'], help='reconstruct (default), or rank: quickly rank the scans by quality from a coarse reconstruction of a few frames, without writing any output', default='reconstruct')
+    parser.add_argument('-i', '--input_file', help='Path to the input raw video file(.SER or uncompressed .AVI file)', default=None)
+    parser.add_argument('-f', '--input_folder', help='Folder of the input raw video files(.SER or uncompressed .AVI files)', default=None)
     parser.add_argument('-o', '--output_folder', help='Output folder(relative to the input file)', default='output/img')
     parser.add_argument('--raw', help='16-bit raw output, without normalization and color mapping', action='store_true', default=False)
     parser.add_argument('-cr', '--correct_light_axis', help='Remove stray light, 1 for gradient in x-axis only, 2 for both axes', type=int, default=2)
@@ -49,13 +89,35 @@ def main():
     parser.add_argument('-c', '--color_map_name', help='Color map', default='orange-enhanced')
     parser.add_argument('-v', '--verbose', help='verbose', type=int, default=0)
     parser.add_argument('-nb', '--normalize_brightness', help='Relative target brightness', type=float, default=1)
+    parser.add_argument('-nw', '--normalize_window', help='Folder mode: share one brightness mapping across the sequence to avoid flicker, 0 for the whole sequence, n for a sliding window of n files on each side', type=int, default=None)
+    parser.add_argument('-r', '--register', help='Register the whole sequence (folder mode) to the same position and scale, e.g. for time-lapse videos', action='store_true', default=False)
+    parser.add_argument('-j', '--jobs', help='Number of worker threads for the registration', type=int, default=1)
+    parser.add_argument('--batch', help='Folder mode: share the folder with other processes or machines, files are claimed with lease files and recorded in a manifest (<output>/.batch), stale claims are retried', action='store_true', default=False)
+    parser.add_argument('--shard', help='Folder mode: only process the files i::n (sorted), e.g. 0/4, implies --batch', default=None)
+    parser.add_argument('--lease', help='Lease of a claim in seconds in the batch mode, renewed while the file is processed', type=float, default=600)
+    parser.add_argument('--dark', help='Dark file(.SER) for the calibration', default=None)
+    parser.add_argument('--flat', help='Flat file(.SER) for the calibration', default=None)
+    parser.add_argument('--flat_dark', help='Dark file(.SER) for the flat, --dark by default', default=None)
+    parser.add_argument('--calibration', help='Calibration file(.npz): written when --dark/--flat is given, loaded otherwise', default=None)
+    parser.add_argument('--backend', help='Kernel backend: auto (numba if installed), numba, numpy', default='auto')
+    parser.add_argument('--rank_frames', help='Frames read per file in the rank mode', type=int, default=128)
+    parser.add_argument('-l', '--lines', help='Extract several spectral lines in one pass: a number for automatic detection (e.g. 2), or column windows (e.g. 40:80,150:190)', default=None)
     args = parser.parse_args()
     print(vars(args))
+    set_backend(args.backend)
+
+    kwargs = vars(args)
+    if args.dark is not None or args.flat is not None:
+        kwargs['calibration'] = make_calibration(args.dark, args.flat, args.flat_dark, output_file = args.calibration, verbose = args.verbose)
+    else:
+        kwargs['calibration'] = load_calibration(args.calibration)
 
-    if args.input_file is not None:
-        process_single_file(**vars(args))
+    if args.mode == 'rank' and (args.input_file is not None or args.input_folder is not None):
+        rank([args.input_file] if args.input_file is not None else list_inputs(args.input_folder), **kwargs)
+    elif args.input_file is not None:
+        process_single_file(**kwargs)
     elif args.input_folder is not None:
-        process_folder(**vars(args))
+        process_folder(**kwargs)
     else:
         parser.print_help()
         raise Exception('Neither -i (single file) nor -f (folder) was specified')
@@ -11,6 +11,7 @@ try:
     import matplotlib.pyplot as plt
 except:
     pass
+from . import backend
 from .utils import print
 
 def find_center(arr):
@@ -25,6 +26,8 @@ def find_center(arr):
     return np.argmin(ret)+a
 
 def find_rising(arr):
+    if backend.use_numba():
+        return backend.find_rising(arr)
     arr = arr.copy()
     for i in range(3, len(arr)//2):
         _arr = arr[:i]
@@ -2,6 +2,7 @@
 @author: Harold Liang (https://lcsky.org)
 """
 
+import math
 import numpy as np
 try:
     import matplotlib.pyplot as plt
@@ -29,21 +30,116 @@ def color_map(img, map_name = 'orange-enhanced', verbose = 0):
     # faster
     return np.array([[_map[item] for item in row] for row in img])
 
-def normalize(img, brightness=1.0, verbose=0):
-    # 方法一：主体部分亮度均衡
-    n, e = np.histogram(img, bins=100)
-    if verbose > 1:
-        plt.plot(n[20:])
-        plt.show()
-    med_idx = np.argsort(n[20:])[::-1] + 20
-    # 直方图最高的3箱
-    idx_a = min(med_idx[:3])
-    idx_b = min(max(med_idx[:3])+1, len(e)-1)
-    med_val_a = e[idx_a]
-    med_val_b = e[idx_b]
-    # 直方图最高的3箱像素均值
-    med_val = np.mean(img[(img>med_val_a) & (img<med_val_b)])
-    # print(med_idx[:3], idx_a, idx_b)
+class histogram_sketch:
+    # 可合并、大小固定的直方图：箱从0开始，宽度为2的幂，数值超出范围时相邻两箱合并、宽度加倍
+    # 同时记录每箱的像素和，可以得到与normalize相同的参考亮度，而不需要保留图像
+    def __init__(self, n_bins = 1024):
+        self.n_bins = n_bins
+        self.bin_width = None
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.sums = np.zeros(n_bins)
+        self.vmin, self.vmax = np.inf, -np.inf
+
+    def _grow(self, bin_width):
+        # 合并相邻的箱，直到宽度达到bin_width
+        if self.bin_width is None:
+            self.bin_width = bin_width
+        while self.bin_width < bin_width:
+            self.counts = np.pad(self.counts.reshape(-1, 2).sum(axis=1), (0, self.n_bins // 2))
+            self.sums = np.pad(self.sums.reshape(-1, 2).sum(axis=1), (0, self.n_bins // 2))
+            self.bin_width *= 2
+
+    def _fit(self, vmax):
+        # 容纳vmax所需的最小的2的幂宽度
+        bin_width = 2.0 ** math.ceil(math.log2(max(vmax, 1e-12) * (1 + 1e-9) / self.n_bins))
+        self._grow(max(bin_width, self.bin_width or 0))
+
+    def add(self, img):
+        img = np.ravel(img)
+        img = img[np.isfinite(img)]
+        if len(img) == 0:
+            return self
+        self.vmin = min(self.vmin, float(np.min(img)))
+        self.vmax = max(self.vmax, float(np.max(img)))
+        self._fit(self.vmax)
+        idx = np.clip((img / self.bin_width).astype(int), 0, self.n_bins - 1)
+        self.counts += np.bincount(idx, minlength=self.n_bins)
+        self.sums += np.bincount(idx, img, minlength=self.n_bins)
+        return self
+
+    def merge(self, other):
+        if other.bin_width is None:
+            return self
+        if self.n_bins != other.n_bins:
+            raise Exception(f'cannot merge sketches of {self.n_bins} and {other.n_bins} bins')
+        other = other.copy()
+        bin_width = max(self.bin_width or 0, other.bin_width)
+        self._grow(bin_width)
+        other._grow(bin_width)
+        self.counts += other.counts
+        self.sums += other.sums
+        self.vmin = min(self.vmin, other.vmin)
+        self.vmax = max(self.vmax, other.vmax)
+        return self
+
+    def copy(self):
+        ret = histogram_sketch(self.n_bins)
+        ret.bin_width, ret.vmin, ret.vmax = self.bin_width, self.vmin, self.vmax
+        ret.counts, ret.sums = self.counts.copy(), self.sums.copy()
+        return ret
+
+    def reference(self, n_hist = 100, n_skip = 20):
+        # 与normalize相同：[min, max]上的100箱直方图，忽略最暗的20箱，取最高3箱内像素的均值
+        if self.bin_width is None:
+            raise Exception('empty sketch')
+        edges = np.linspace(self.vmin, self.vmax, n_hist + 1)
+        centers = (np.arange(self.n_bins) + 0.5) * self.bin_width
+        coarse = np.clip(np.searchsorted(edges, centers, side='right') - 1, 0, n_hist - 1)
+        n = np.bincount(coarse, self.counts, n_hist)
+        med_idx = np.argsort(n[n_skip:])[::-1] + n_skip
+        idx_a = min(med_idx[:3])
+        idx_b = min(max(med_idx[:3])+1, n_hist)
+        selected = (coarse >= idx_a) & (coarse < idx_b)
+        return np.sum(self.sums[selected]) / max(np.sum(self.counts[selected]), 1)
+
+    def save(self, file):
+        np.savez(file, counts=self.counts, sums=self.sums, meta=[self.bin_width or 0, self.vmin, self.vmax])
+
+    @staticmethod
+    def load(file):
+        with np.load(file) as data:
+            ret = histogram_sketch(len(data['counts']))
+            ret.counts, ret.sums = data['counts'], data['sums']
+            bin_width, ret.vmin, ret.vmax = data['meta']
+            ret.bin_width = bin_width if bin_width > 0 else None
+        return ret
+
+def merge_sketches(sketches):
+    # 合并多个直方图（例如一段时间内的图像，或并行处理的结果），返回新的直方图
+    ret = None
+    for sketch in sketches:
+        ret = sketch.copy() if ret is None else ret.merge(sketch)
+    return ret
+
+def normalize(img, brightness=1.0, verbose=0, sketch=None):
+    if sketch is not None:
+        # 使用整个序列（或滑动窗口内）合并的直方图，序列中各图像的亮度映射一致，不闪烁
+        med_val = sketch.reference()
+    else:
+        # 方法一：主体部分亮度均衡
+        n, e = np.histogram(img, bins=100)
+        if verbose > 1:
+            plt.plot(n[20:])
+            plt.show()
+        med_idx = np.argsort(n[20:])[::-1] + 20
+        # 直方图最高的3箱
+        idx_a = min(med_idx[:3])
+        idx_b = min(max(med_idx[:3])+1, len(e)-1)
+        med_val_a = e[idx_a]
+        med_val_b = e[idx_b]
+        # 直方图最高的3箱像素均值
+        med_val = np.mean(img[(img>med_val_a) & (img<med_val_b)])
+        # print(med_idx[:3], idx_a, idx_b)
     # print(med_val)
     img = np.clip(img/med_val*152*brightness, 0, 255)
 
@@ -0,0 +1,135 @@
+"""
+@author: Harold Liang (https://lcsky.org)
+
+quick quality triage of a session's scans: a coarse reconstruction from every n-th frame, without the full reconstruction
+"""
+
+import time
+import numpy as np
+from einops import reduce
+from .video_reader import video_reader
+from .spectrum import find_edge, reduce_mean, fit_line_with_poly, reconstruct
+from .shape_correction import find_edge_points, filter_out_invalid_points, fit_ellipse
+from .calibration import load_calibration
+from .utils import print
+
+def _ellipse_radius(points, ellipse):
+    # 点(x, y)在椭圆坐标系中的归一化半径，椭圆上为1
+    center, width, height, phi = ellipse
+    phi = np.deg2rad(phi)
+    dx, dy = (points - center).T
+    u = dx * np.cos(phi) + dy * np.sin(phi)
+    v = -dx * np.sin(phi) + dy * np.cos(phi)
+    return np.hypot(u / width, v / height)
+
+def _ellipse_residual(points, ellipse):
+    # 边缘点到拟合椭圆的相对径向距离的均方根
+    return float(np.sqrt(np.mean((_ellipse_radius(points, ellipse) - 1) ** 2)))
+
+def _coverage(ellipse, w, h):
+    # 日面在扫描方向（帧）与狭缝方向上落在画面内的比例
+    center, width, height, phi = ellipse
+    phi = np.deg2rad(phi)
+    ret = 1.0
+    for c, half, size in [
+        (center[0], np.hypot(width * np.cos(phi), height * np.sin(phi)), w),
+        (center[1], np.hypot(width * np.sin(phi), height * np.cos(phi)), h),
+    ]:
+        inside = min(c + half, size - 1) - max(c - half, 0)
+        ret *= float(np.clip(inside / (2 * half), 0, 1))
+    return ret
+
+def _sharpness(img, ellipse, block = 8):
+    # 日面内沿狭缝方向的归一化梯度能量，减去像素噪声的贡献，否则噪声大的扫描显得更清晰；扫描方向被降采样，不参与计算
+    # 噪声用同一组像素上四阶差分的均方估计：白噪声的一阶差分均方为2σ²，四阶为70σ²，二者都是方差的线性平均，
+    # 噪声沿狭缝变化（插值权重、亮度）时相减仍然无偏；日面的信号集中在低频，四阶差分中很少。
+    # 噪声越大，估计的涨落越大，取置信下界（减去3倍标准误差，按沿狭缝block行分块估计），保证增加噪声不会提高得分
+    h, w = img.shape
+    yy, xx = np.mgrid[:h, :w]
+    mask = (_ellipse_radius(np.stack([xx.reshape(-1), yy.reshape(-1)], axis=1), ellipse) < 0.9).reshape(h, w)
+    mask = mask[2:-2]
+    if np.count_nonzero(mask) < 16:
+        return 0.0
+    grad = img[3:-1] - img[2:-2]
+    d4 = np.diff(img, 4, axis=0)
+    q = np.where(mask, grad ** 2 - 2 * d4 ** 2 / 70, 0)
+    n = len(q) // block * block
+    sums = q[:n].reshape(-1, block * w).sum(axis=1)
+    counts = mask[:n].reshape(-1, block * w).sum(axis=1)
+    sums, counts = sums[counts > 0], counts[counts > 0]
+    energy = np.sum(sums) / np.sum(counts)
+    se = np.sqrt(np.sum((sums - counts * energy) ** 2)) / np.sum(counts)
+    energy = max(float(energy - 3 * se), 0.0)
+    return energy / float(np.mean(img[2:-2][mask])) ** 2 * 1e3
+
+def scan_quality(file, n_frames = 128, calibration = None, verbose = 0):
+    """
+    scan_quality 只读取约n_frames帧，粗略重建后评估扫描质量
+    scan_quality estimate the quality of a scan from a coarse reconstruction of about n_frames frames
+
+    :param file: 输入ser/avi文件路径，或其他帧来源，参见video_reader.open
+    :param file: input ser/avi file path, or another frame source, see video_reader.open
+    :param n_frames: 读取的帧数，均匀分布在整个扫描中
+    :param n_frames: number of frames to read, evenly spread over the scan
+    :param calibration: 暗场、平场校准，make_calibration的结果或保存的校准文件路径
+    :param calibration: dark and flat calibration, the result of make_calibration or the path of a saved calibration file
+    :param verbose: 0~3，log information level
+    :return: {'sharpness': 日面内沿狭缝方向的归一化梯度能量，已减去像素噪声的贡献并取置信下界，噪声大的扫描不会得分更高（越大越清晰）, 'residual': 日面边缘相对椭圆拟合的残差（越小越好）, 'coverage': 日面被完整扫描的比例, 'dropped': 由时间戳估计的丢帧数（会使日面变形）, 'frames': 读取的帧数, 'time': 耗时(s)}
+    :return: {'sharpness': normalized gradient energy along the slit inside the disc, with the pixel noise contribution subtracted, as a lower confidence bound so that noisier scans never score higher (higher is sharper), 'residual': relative rms of the limb around the fitted ellipse (lower is better), 'coverage': fraction of the disc inside the scan, 'dropped': frames dropped during the capture according to the timestamps (they distort the disc), 'frames': frames read, 'time': seconds}
+    """
+    t0 = time.time()
+    reader = video_reader.open(file, auto_rotate_vertical=True)
+    dropped = sum(n for i, n in reader.dropped_frames())
+    step = max(1, reader.frames // n_frames)
+    reader = reader.subset(range(0, reader.frames, step))
+    calibration = load_calibration(calibration)
+
+    img_mean = reduce_mean(reader, calibration)
+    curve = reduce(img_mean.astype(float), 'h w -> h', 'mean')
+    y1, y2 = find_edge(curve)
+    fit = fit_line_with_poly(img_mean, y1, y2)
+
+    # 谱线中心与日面边缘检测用的偏移在同一次读取中完成
+    imgs = reconstruct(reader, fit, shifts = [0, 10], calibration = calibration)
+    img, raw_lines = imgs[0], imgs[1].T
+    edge_points = filter_out_invalid_points(find_edge_points(raw_lines), 8)
+
+    ret = {'sharpness': 0.0, 'residual': np.nan, 'coverage': 0.0, 'dropped': dropped, 'frames': reader.frames}
+    try:
+        ellipse = fit_ellipse(edge_points, raw_lines)
+        w, h = raw_lines.shape
+        points = np.array([[x, y] for x, ys in enumerate(edge_points) for y in ys if not np.isnan(y) and y > h*0.05 and y < h*0.95])
+        ret['residual'] = _ellipse_residual(points, ellipse)
+        ret['coverage'] = _coverage(ellipse, w, h)
+        ret['sharpness'] = _sharpness(img, ellipse)
+    except Exception as e:
+        if verbose > 0:
+            print(f'ellipse fitting failed: {e}')
+    ret['time'] = time.time() - t0
+    if verbose > 0:
+        print(ret)
+    return ret
+
+def rank_files(files, n_frames = 128, min_coverage = 0.98, calibration = None, verbose = 0):
+    """
+    rank_files 按扫描质量对文件排序：日面完整的扫描按清晰度从高到低排列，不完整或边缘拟合失败的排在最后
+    rank_files rank files by scan quality: complete scans by sharpness (highest first), incomplete scans or failed limb fits last
+
+    :param files: 文件列表
+    :param files: list of files
+    :param n_frames: 每个文件读取的帧数
+    :param n_frames: frames read per file
+    :param min_coverage: 视为完整扫描的最小覆盖比例
+    :param min_coverage: minimal coverage of a complete scan
+    :return: [(file, scan_quality的结果), ...]，从好到差
+    :return: [(file, result of scan_quality), ...], best first
+    """
+    calibration = load_calibration(calibration)
+    results = []
+    for file in files:
+        try:
+            results.append((file, scan_quality(file, n_frames = n_frames, calibration = calibration, verbose = verbose)))
+        except Exception as e:
+            print(f'{file}: {e}')
+            results.append((file, {'sharpness': 0.0, 'residual': np.nan, 'coverage': 0.0, 'dropped': 0, 'frames': 0, 'time': 0.0}))
+    return sorted(results, key = lambda r: (not (r[1]['coverage'] >= min_coverage and np.isfinite(r[1]['residual'])), -r[1]['sharpness']))
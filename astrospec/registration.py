@@ -0,0 +1,168 @@
+"""
+@author: Harold Liang (https://lcsky.org)
+
+references:
+1. C. D. Kuglin, D. C. Hines, The phase correlation image alignment method, 1975
+"""
+
+import cv2
+import math
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .utils import print
+
+def downsample(img, size = 256):
+    # 缩小到size x size，用于配准
+    img = np.nan_to_num(np.asarray(img, dtype=np.float32))
+    return cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA)
+
+def _whiten(imgs):
+    # 去均值、归一化并加汉宁窗，减弱图像边缘的影响
+    imgs = np.asarray(imgs, dtype=np.float64)
+    imgs = imgs - np.mean(imgs, axis=(-2,-1), keepdims=True)
+    imgs /= np.std(imgs, axis=(-2,-1), keepdims=True) + 1e-9
+    h, w = imgs.shape[-2:]
+    return imgs * np.outer(np.hanning(h), np.hanning(w))
+
+def _subpixel_peak(r):
+    # 批量求相关峰位置，并用抛物线拟合得到亚像素偏移
+    n, h, w = r.shape
+    idx = np.argmax(np.reshape(r, (n, -1)), axis=1)
+    py, px = np.unravel_index(idx, (h, w))
+    i = np.arange(n)
+    ret = []
+    for p, size, get in [
+        (py, h, lambda d: r[i, (py+d) % h, px]),
+        (px, w, lambda d: r[i, py, (px+d) % w]),
+    ]:
+        a, b, c = get(-1), get(0), get(1)
+        denom = a - 2*b + c
+        frac = np.where(np.abs(denom) > 1e-12, (a - c) / (2*denom + 1e-30), 0)
+        p = p + np.clip(frac, -0.5, 0.5)
+        # 超过一半视为负偏移
+        p = np.where(p > size/2, p - size, p)
+        ret.append(p)
+    return np.stack(ret, axis=1)
+
+def phase_correlation(imgs, ref):
+    """
+    phase_correlation 批量相位相关，返回每张图像相对参考图像的平移 (dy, dx)，即 imgs[i](x) ≈ ref(x - d)
+    phase_correlation batched phase correlation, return the translation (dy, dx) of each image relative to the reference, i.e. imgs[i](x) ≈ ref(x - d)
+
+    :param imgs: 图像，(n, h, w)
+    :param imgs: images, (n, h, w)
+    :param ref: 参考图像，(h, w)
+    :param ref: reference image, (h, w)
+    :return: np.array (n, 2)
+    """
+    f = np.fft.rfft2(_whiten(imgs))
+    f_ref = np.fft.rfft2(_whiten(ref))
+    return _correlation_peak(f, f_ref, np.shape(imgs)[-2:])
+
+def _correlation_peak(f, f_ref, shape, phase_only = True):
+    cross = f * np.conj(f_ref)
+    if phase_only:
+        cross /= np.abs(cross) + 1e-12
+    r = np.fft.irfft2(cross, s=shape)
+    return _subpixel_peak(r)
+
+def _disc_center(img):
+    # 日面（高于均值的部分）的质心，不受缩放影响
+    mask = img > np.mean(img)
+    yy, xx = np.nonzero(mask)
+    if len(yy) == 0:
+        return np.array(img.shape) / 2
+    return np.array([np.mean(yy), np.mean(xx)]) + 0.5
+
+def _log_radial_profile(img, center, n_bins, log_base):
+    # 以center为原点、沿角度平均的对数半径剖面，线性插值到n_bins个箱
+    h, w = img.shape
+    yy, xx = np.mgrid[:h, :w]
+    r = np.hypot(yy + 0.5 - center[0], xx + 0.5 - center[1])
+    pos = np.log(np.maximum(r, 1)) / log_base
+    idx = np.minimum(pos.astype(int), n_bins - 2).reshape(-1)
+    frac = (pos.reshape(-1) - idx)
+    img = np.reshape(img, -1)
+    counts = np.bincount(idx, 1 - frac, n_bins) + np.bincount(idx + 1, frac, n_bins) + 1e-9
+    p = (np.bincount(idx, img * (1 - frac), n_bins) + np.bincount(idx + 1, img * frac, n_bins)) / counts
+    # 梯度突出日面边缘，忽略中心附近采样不足的部分
+    p = np.diff(p)
+    p[:n_bins//2] = 0
+    return p
+
+def _scale(imgs, ref):
+    # 以各自日面中心为原点，缩放变成对数半径方向的平移，与平移无关
+    # 日面图像以圆盘边缘为主，几乎不含角度信息，因此不估计旋转，只比较沿角度平均的剖面
+    h, w = np.shape(ref)
+    n_bins = w * 2
+    log_base = math.log(math.hypot(h, w)) / n_bins
+    profiles = np.array([_log_radial_profile(img, _disc_center(img), n_bins, log_base) for img in imgs])[:, np.newaxis, :]
+    profile_ref = _log_radial_profile(ref, _disc_center(ref), n_bins, log_base)[np.newaxis, :]
+    d = _correlation_peak(np.fft.rfft2(profiles), np.fft.rfft2(profile_ref), profiles.shape[-2:], phase_only = False)
+    return np.exp(d[:, 1] * log_base)
+
+def _scaling(center, scale):
+    # 绕center缩放，3x3矩阵
+    cx, cy = center
+    return np.float64([
+        [scale, 0, cx - scale*cx],
+        [0, scale, cy - scale*cy],
+        [0, 0, 1],
+    ])
+
+def rescale_transform(M, factor):
+    # 把缩小图像上的变换矩阵转换到factor倍大小的图像上
+    D = np.diag([factor, factor, 1.0])
+    return D @ M @ np.linalg.inv(D)
+
+def register_sequence(imgs, ref = 0, size = 256, estimate_scale = True, batch_size = 16, n_jobs = 1, verbose = 0):
+    """
+    register_sequence 用降采样图像上的批量相位相关，把整个序列配准到参考帧，返回可叠加到warp_frame中的变换矩阵
+    register_sequence align a whole sequence to a reference with batched phase correlation on downsampled images, return transforms that can be folded into warp_frame
+
+    :param imgs: 图像序列（尺寸相同），可以已经是降采样后的图像
+    :param imgs: image sequence of the same size, may already be downsampled
+    :param ref: 参考帧序号，或参考图像
+    :param ref: index of the reference frame, or the reference image
+    :param size: 降采样后的大小
+    :param size: size of the downsampled images
+    :param estimate_scale: 是否估计缩放（否则只估计平移）
+    :param estimate_scale: whether to estimate the scale (translation only otherwise)
+    :param batch_size: 每批FFT的图像数量
+    :param batch_size: images per batched FFT
+    :param n_jobs: 并行线程数
+    :param n_jobs: number of worker threads
+    :param verbose: 0~3，log information level
+    :return: 每张图像的3x3变换矩阵（输入图像坐标），将图像映射到参考帧
+    :return: 3x3 matrix per image in the coordinates of the input images, mapping the image onto the reference
+    """
+    h, w = np.shape(imgs[0])
+    factor = w / size
+    small = np.array([downsample(img, size) if img.shape != (size, size) else np.asarray(img, dtype=np.float32) for img in imgs])
+    ref = small[ref] if np.ndim(ref) == 0 else downsample(ref, size)
+    center = (size / 2, size / 2)
+
+    def register_batch(batch):
+        scales = np.ones(len(batch))
+        if estimate_scale:
+            # 先估计缩放，消除缩放后再估计平移
+            scales = _scale(batch, ref)
+            batch = np.array([cv2.warpAffine(img, _scaling(center, 1/s)[:2,:], (size, size)) for img, s in zip(batch, scales)])
+        shifts = phase_correlation(batch, ref)
+        ret = []
+        for (dy, dx), s in zip(shifts, scales):
+            M = np.float64([[1, 0, -dx], [0, 1, -dy], [0, 0, 1]]) @ _scaling(center, 1/s)
+            ret.append(rescale_transform(M, factor))
+        return ret, shifts, scales
+
+    batches = [small[i:i+batch_size] for i in range(0, len(small), batch_size)]
+    with ThreadPoolExecutor(max(1, n_jobs)) as pool:
+        results = list(pool.map(register_batch, batches))
+
+    transforms = [M for ret, _, _ in results for M in ret]
+    if verbose > 0:
+        for i, (dy, dx) in enumerate(np.concatenate([r[1] for r in results])):
+            print(f'{i}: shift = ({dy*factor:.2f}, {dx*factor:.2f})')
+    if verbose > 1 and estimate_scale:
+        print(f'scales = {np.concatenate([r[2] for r in results])}')
+    return transforms
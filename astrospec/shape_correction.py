@@ -12,9 +12,12 @@ except:
 from einops import rearrange, reduce, repeat
 from ellipse import LsqEllipse
 from .spectrum import reduce_mean, fit_line_with_poly, frame_to_line, reconstruct
+from . import backend
 from .utils import print
 
 def cross_points(arr, thd):
+    if backend.use_numba():
+        return backend.cross_points(arr, thd)
     # TODO: 施密特触发
     idxes = [
         np.argmax((arr[:-1] <= thd) & (arr[1:] > thd)),
@@ -27,39 +30,40 @@ def cross_points(arr, thd):
         ret.append(idx + (thd-a)/(b-a))
     return ret
 
-def detect_edge_points(reader, fit, shifts=[10], verbose=0):
-    lines = []
-    raw_lines = []
-    line_maxval = []
-    for i,img in enumerate(reader):
-        # line = gaussian_filter(reduce(img.astype(float), 'h w -> h', 'mean'), sigma=3)
-        # print(i)
-        line = frame_to_line(img, fit, shifts=shifts)
-        line = line.astype(float)[0,:]
-        # line = gaussian_filter(line, sigma=3)
-        raw_lines.append(line)
-        # 变化最快
-        # line = line[:-1] - line[1:]
-        # lines.append([np.argmin(line), np.argmax(line)])
-        # 穿过1/4最大强度
-        _min = np.min(line)
-        thd_val = (np.max(line) - _min)
-        line_maxval.append(thd_val)
-        thd_val = _min + thd_val/4
-        lines.append(cross_points(line, thd_val))
-        if verbose > 3 and (i%50) == 0:
-            plt.plot(line, color='r')
-            plt.show()
+def detect_edge_points(reader, fit, shifts=[10], calibration=None, verbose=0):
+    raw_lines = reconstruct(reader, fit, shifts[:1], calibration)[0].T
+    return find_edge_points(raw_lines, verbose), raw_lines
+
+def find_edge_points(raw_lines, verbose=0):
+    # raw_lines: 每帧偏离谱线的一行 (frames, h)，返回每帧日面边缘的两个位置
+    if backend.use_numba() and verbose <= 3:
+        lines, line_maxval = backend.edge_points(raw_lines)
+    else:
+        lines = []
+        line_maxval = []
+        for i,line in enumerate(raw_lines):
+            # line = gaussian_filter(line, sigma=3)
+            # 变化最快
+            # line = line[:-1] - line[1:]
+            # lines.append([np.argmin(line), np.argmax(line)])
+            # 穿过1/4最大强度
+            _min = np.min(line)
+            thd_val = (np.max(line) - _min)
+            line_maxval.append(thd_val)
+            thd_val = _min + thd_val/4
+            lines.append(cross_points(line, thd_val))
+            if verbose > 3 and (i%50) == 0:
+                plt.plot(line, color='r')
+                plt.show()
 
-    line_maxval = np.array(line_maxval)
-    lines = np.array(lines)
-    raw_lines = np.array(raw_lines)
+        line_maxval = np.array(line_maxval)
+        lines = np.array(lines)
     
     # 去除太暗的结果
     invalid = line_maxval < np.max(line_maxval) / 4
     lines[invalid,:] = np.nan
 
-    return lines, raw_lines
+    return lines
 
 def filter_out_invalid_points(x, thd):
     x = x.copy()
@@ -88,10 +92,11 @@ def fit_ellipse(edge_points, raw_lines, verbose=0):
     try:
         reg = LsqEllipse().fit(points)
     except Exception as e:
-        ax = plt.subplot()
-        ax.imshow(raw_lines.T)
-        ax.scatter(points[:,0], points[:,1], marker='x', c='r')
-        plt.show()
+        if verbose > 0:
+            ax = plt.subplot()
+            ax.imshow(raw_lines.T)
+            ax.scatter(points[:,0], points[:,1], marker='x', c='r')
+            plt.show()
         raise e
     
     center, width, height, phi = reg.as_parameters()
@@ -116,7 +121,8 @@ def fit_ellipse(edge_points, raw_lines, verbose=0):
 
     return (center, width, height, phi)
 
-def warp_frame(ellipse, img, sz, sun_percentage = 0.8):
+def warp_frame(ellipse, img, sz, sun_percentage = 0.8, transform = None):
+    # transform: 额外的3x3变换（例如序列配准结果），与椭圆矫正合并，只重采样一次
     center, width, height, phi = ellipse
     
     # TODO: 旋转
@@ -158,6 +164,8 @@ def warp_frame(ellipse, img, sz, sun_percentage = 0.8):
             M = _m
         else:
             M = _m @ M
+    if transform is not None:
+        M = transform @ M
 
     img = cv2.warpAffine(img, M[:2,:], (sz, sz))
     return img
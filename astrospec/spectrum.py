@@ -15,15 +15,55 @@ try:
 except:
     pass
 from numpy.polynomial.polynomial import polyval
+from . import backend
 from .utils import print
 
-def reduce_mean(reader):
-    n = 0
-    imgs = np.zeros((reader.height, reader.width), dtype='uint64')
-    for img in reader:
-        imgs += img
-        n += 1
-    return (imgs / n).astype('uint16')
+def calibration_frames(calibration, shape):
+    # 校准数据中的暗场和增益（原始方向），检查尺寸
+    if calibration is None:
+        return None, None
+    dark, gain = calibration.get('dark'), calibration.get('gain')
+    for v in (dark, gain):
+        if v is not None and v.shape != tuple(shape):
+            raise Exception(f'calibration shape {v.shape} does not match the frame shape {tuple(shape)}')
+    return dark, gain
+
+def reduce_mean(reader, calibration = None, dtype = 'uint16', return_max = False):
+    # return_max: 同时返回各像素在所有帧中的最大值（竖直方向，float64），在同一次读取中统计
+    # 在原始布局上按块累加，只对最终结果旋转一次；无符号整数块内用uint32求和（64帧16位数据不会溢出），带宽减半
+    # 有符号整数与浮点数（例如已减暗场的帧）分别用int64、float64累加，不能用无符号类型
+    kind, itemsize = np.dtype(reader.dtype).kind, np.dtype(reader.dtype).itemsize
+    if kind == 'u':
+        total, acc = 'uint64', 'uint32' if itemsize <= 2 else 'uint64'
+    elif kind == 'i':
+        total = acc = 'int64'
+    else:
+        total = acc = 'float64'
+    imgs = np.zeros((reader._height, reader._width), dtype=total)
+    img_max = None
+    for i, frames in reader.frame_blocks():
+        imgs += np.sum(frames, axis=0, dtype=acc)
+        if return_max:
+            img_max = np.max(frames, axis=0) if img_max is None else np.maximum(img_max, np.max(frames, axis=0))
+    imgs = imgs / reader.frames
+    # 校准是线性的，直接作用于平均帧；增益为正，最大值同样可以在统计后校准
+    dark, gain = calibration_frames(calibration, imgs.shape)
+    ret = []
+    for img in [imgs, img_max] if return_max else [imgs]:
+        img = img.astype(float)
+        if dark is not None:
+            img = img - dark
+        if gain is not None:
+            img = img * gain
+        if reader.rotate:
+            img = np.ascontiguousarray(np.rot90(img))
+        ret.append(img)
+    imgs = ret[0]
+    if dtype == 'uint16':
+        imgs = np.clip(imgs, 0, 65535)
+    if return_max:
+        return imgs.astype(dtype), ret[1]
+    return imgs.astype(dtype)
 
 def find_edge(curve, verbose=0):
     expend = 0
@@ -44,29 +84,109 @@ def find_edge(curve, verbose=0):
         plt.show()
     return x0, x1
 
-# TODO: 自转导致的多普勒效应，会被拟合抹平，要单独拍一个天光进行曲线拟合
-def fit_line_with_poly(img, y1, y2, denoise=False, verbose = 0):
+def find_illuminated(img_max, fit, shifts = [0], margin = 0.02):
+    """
+    find_illuminated 狭缝上任意一帧中谱线（及各偏移）处有光的行：日面外的日珥只在谱线中心有光、平均帧中看不到，因此用谱线处各帧的最大值判断
+    find_illuminated rows of the slit where the line (and its shifts) is lit in any frame: prominences off the limb only show in the line core and not in the mean frame, so the per frame maximum at the line is used
+
+    :param img_max: 各帧的最大值（竖直方向），reduce_mean(return_max=True)的结果
+    :param img_max: per pixel maximum over the frames (vertical layout), from reduce_mean(return_max=True)
+    :param fit: 谱线位置，(ih,) 或 (n_lines, ih)
+    :param fit: line positions, (ih,) or (n_lines, ih)
+    :return: (y1, y2)；没有明显的暗行时为全部行
+    :return: (y1, y2); all rows if there are no clearly dark rows
+    """
+    ih = img_max.shape[0]
+    core = np.max(np.reshape(frame_to_line(img_max, fit, shifts), (-1, ih)), axis=0)
+    floor = np.quantile(core, 0.05)
+    peak = np.quantile(core, 0.99)
+    # 暗行（狭缝两端被遮挡、传感器范围外）的最大值只有噪声；亮度接近暗行的行很少或差别不明显时不裁剪
+    dark = core < floor + (peak - floor) * 0.1
+    if np.count_nonzero(dark) < 8 or floor > peak * 0.25:
+        return 0, ih
+    d = np.diff(core)[dark[:-1] & dark[1:]]
+    noise = 1.4826 * np.median(np.abs(d - np.median(d))) / np.sqrt(2) if len(d) > 0 else 0
+    rows = np.nonzero(core > floor + max(5 * noise, (peak - floor) * 0.02))[0]
+    if len(rows) == 0:
+        return 0, ih
+    e = max(4, int(ih * margin))
+    return int(max(0, rows[0] - e)), int(min(ih, rows[-1] + 1 + e))
+
+def find_lines(img, y1, y2, n_lines = 1, max_half_width = None, min_depth = 0.05, verbose = 0):
+    """
+    find_lines 在平均帧中自动寻找最深的n_lines条谱线，返回各谱线的列窗口
+    find_lines detect the n_lines deepest spectral lines in the mean frame, return a column window for each line
+
+    :param img: 平均帧，竖直方向
+    :param img: mean frame, vertical layout
+    :param n_lines: 谱线数量
+    :param n_lines: number of lines to detect
+    :param max_half_width: 窗口最大半宽（像素），默认为宽度的1/8
+    :param max_half_width: maximal half width of a window in pixels, 1/8 of the frame width by default
+    :param min_depth: 谱线的最小深度，相对于最深的谱线；同时要求深度超过噪声的5倍
+    :param min_depth: minimal depth of a line, relative to the deepest line; the depth must also exceed 5 times the noise
+    :return: [(x1, x2), ...] 按x排序
+    :return: [(x1, x2), ...] sorted by x
+    """
     ih, iw = img.shape
-    if denoise:
-        blur_x = 3
-        blur_y = int((y2 - y1) * 0.01)
-        img = cv2.blur(img, ksize=(blur_x, blur_y))
+    if max_half_width is None:
+        max_half_width = max(3, iw // 8)
+    # 只用中间部分的行，减小谱线弯曲的影响
+    yc = (y1 + y2) // 2
+    band = max(1, (y2 - y1) // 10)
+    profile = np.mean(img[max(0, yc-band):yc+band].astype(float), axis=0)
+
+    # 局部极小值，深度相对于两侧的局部最大值
+    r = 3
+    padded = np.pad(profile, r, mode='edge')
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2*r+1)
+    is_min = profile <= np.min(windows, axis=1)
+    padded = np.pad(profile, 4*r, mode='edge')
+    depth = np.max(np.lib.stride_tricks.sliding_window_view(padded, 8*r+1), axis=1) - profile
+    depth[~is_min] = 0
+    # 噪声用二阶差分的MAD稳健估计（白噪声的二阶差分方差为6σ²），更浅的起伏不算谱线
+    d2 = np.diff(profile, 2)
+    sigma = 1.4826 * np.median(np.abs(d2 - np.median(d2))) / np.sqrt(6)
+    threshold = max(5 * sigma, min_depth * np.max(depth), 0)
 
-    x_ymins_int = np.argmin(img, axis = 1)
+    xs = []
+    for x in np.argsort(depth)[::-1]:
+        if len(xs) >= n_lines or depth[x] <= threshold:
+            break
+        if all(abs(x - _x) > 2*r for _x in xs):
+            xs.append(x)
+    if len(xs) < n_lines:
+        raise Exception(f'only {len(xs)} of {n_lines} lines detected')
+    xs = sorted(int(x) for x in xs)
 
+    # 窗口边界取相邻谱线的中点
+    bounds = [0] + [(a + b + 1) // 2 for a, b in zip(xs[:-1], xs[1:])] + [iw]
+    ret = [(max(bounds[i], x-max_half_width), min(bounds[i+1], x+max_half_width+1)) for i, x in enumerate(xs)]
+    if verbose > 0:
+        print(f'lines at {xs}, windows = {ret}')
+    if verbose > 1:
+        plt.plot(profile)
+        for x1, x2 in ret:
+            plt.axvspan(x1, x2, alpha=0.2)
+        plt.show()
+    return ret
+
+def fit_parabola_rows(img, x_ymins_int, y1, y2, wx1, wx2, n_fit_pixels, verbose = 0):
+    # 逐行在最小值左右各n_fit_pixels个点内拟合二次曲线，返回极小值位置（参考实现）
     x_ymins = []
-    # 通过左右各n_fit_pixels个点拟合
-    n_fit_pixels = 2
     for y in range(y1, y2):
-        x1 = max(0, x_ymins_int[y]-n_fit_pixels)
-        x2 = min(iw, x_ymins_int[y]+n_fit_pixels+1)
+        x1 = max(wx1, x_ymins_int[y]-n_fit_pixels)
+        x2 = min(wx2, x_ymins_int[y]+n_fit_pixels+1)
         row = img[y, x1:x2]
         # 一元二次方程
         # print(x1, x2)
         poly = np.polyfit(np.arange(x1, x2), row, 2)
         a, b, c = poly
-        # 最小值
-        x_ymin = -b/(2*a)
+        # 最小值；平坦或共线的行没有极值，取窗口中心（与numba后端一致）
+        if abs(a) <= 1e-9 * (np.max(np.abs(row)) + 1):
+            x_ymin = (x1 + x2 - 1) / 2
+        else:
+            x_ymin = -b/(2*a)
         x_ymins.append(x_ymin)
         # print(poly, x_ymin)
 
@@ -79,6 +199,26 @@ def fit_line_with_poly(img, y1, y2, denoise=False, verbose = 0):
             plt.axvline(x_ymin, color='r')
             # print(row)
             plt.show()
+    return np.array(x_ymins)
+
+# TODO: 自转导致的多普勒效应，会被拟合抹平，要单独拍一个天光进行曲线拟合
+def fit_line_with_poly(img, y1, y2, denoise=False, window=None, verbose = 0):
+    ih, iw = img.shape
+    if denoise:
+        blur_x = 3
+        blur_y = int((y2 - y1) * 0.01)
+        img = cv2.blur(img, ksize=(blur_x, blur_y))
+
+    # 只在窗口[wx1, wx2)内寻找谱线
+    wx1, wx2 = (0, iw) if window is None else window
+    x_ymins_int = np.argmin(img[:, wx1:wx2], axis = 1) + wx1
+
+    # 通过左右各n_fit_pixels个点拟合
+    n_fit_pixels = 2
+    if backend.use_numba() and verbose <= 3:
+        x_ymins = backend.fit_parabola_rows(img, x_ymins_int, y1, y2, wx1, wx2, n_fit_pixels)
+    else:
+        x_ymins = fit_parabola_rows(img, x_ymins_int, y1, y2, wx1, wx2, n_fit_pixels, verbose)
 
     x_ymins = np.array(x_ymins)
     filter_size = 20
@@ -109,35 +249,120 @@ def fit_line_with_poly(img, y1, y2, denoise=False, verbose = 0):
         plt.show()
     return fit
 
-def frame_to_line(img, fit, shifts = [0], verbose = 0):
-    ih, iw = img.shape
-    lines = []
-    for shift in shifts:
-        fit_with_shift = fit + np.ones(ih)*shift
-        idx_l = fit_with_shift.astype(int)
-    
-        # 防止超出图像边缘
-        idx_l[idx_l < 0] = 0
-        idx_l[idx_l > iw - 2] = iw - 2
-        idx_r = (idx_l + np.ones(ih)).astype(int)
-        
-        # TODO: 亚像素偏移拟合先验分布？
-        left_weights = np.ones(ih) - (fit_with_shift - fit_with_shift.astype(int))
-        right_weights = np.ones(ih) - left_weights
-        
-        left_col = img[np.arange(ih), idx_l]
-        right_col = img[np.arange(ih), idx_r]
-        value = left_col * left_weights + right_col * right_weights
-        lines.append(value)
+def line_sampler(fit, shifts, shape, rotate = False, calibration = None):
+    """
+    line_sampler 预先计算亚像素插值在原始(行优先)帧中的一维索引和权重，旋转由索引完成而非np.rot90
+    line_sampler precompute flat indices into the native (row-major) frame and the sub-pixel weights, orientation is handled by index math instead of np.rot90
+
+    :param fit: 谱线位置，(ih,) 或多条谱线 (n_lines, ih)
+    :param fit: line positions, (ih,) or (n_lines, ih) for several lines
+    :param shape: 原始帧尺寸 (height, width)
+    :param shape: native frame shape (height, width)
+    :param rotate: 原始帧是否需要逆时针旋转90度才是竖直方向
+    :param rotate: whether the native frame is rotated by 90 degrees (counter-clockwise) to get the vertical layout
+    :param calibration: 暗场、平场校准数据，合并到权重和偏置中，只校准被采样的像素
+    :param calibration: dark and flat calibration, folded into the weights and an offset so only the sampled pixels are corrected
+    :return: (idx_l, idx_r, left_weights, right_weights, offset), 形状均为 (n_lines*len(shifts), ih)
+    """
+    nh, nw = shape
+    ih, iw = (nw, nh) if rotate else (nh, nw)
+    fit = np.reshape(fit, (-1, 1, ih))
+    fit_with_shift = np.reshape(fit + np.array(shifts, dtype=float)[:, np.newaxis], (-1, ih))
+    idx_l = fit_with_shift.astype(int)
+
+    # 防止超出图像边缘
+    idx_l[idx_l < 0] = 0
+    idx_l[idx_l > iw - 2] = iw - 2
+
+    # TODO: 亚像素偏移拟合先验分布？
+    left_weights = 1 - (fit_with_shift - fit_with_shift.astype(int))
+    right_weights = 1 - left_weights
+
+    y = np.arange(ih)
+    if rotate:
+        # np.rot90(img)[y, x] == img[x, nw-1-y]
+        idx_l = idx_l * nw + (nw - 1 - y)
+        idx_r = idx_l + nw
+    else:
+        idx_l = y * nw + idx_l
+        idx_r = idx_l + 1
+
+    # (img - dark) * gain 的插值 = 权重乘以增益后的插值 - 暗场的相同插值
+    offset = np.zeros(idx_l.shape)
+    dark, gain = calibration_frames(calibration, shape)
+    if gain is not None:
+        left_weights = left_weights * gain.reshape(-1)[idx_l]
+        right_weights = right_weights * gain.reshape(-1)[idx_r]
+    if dark is not None:
+        offset = dark.reshape(-1)[idx_l] * left_weights + dark.reshape(-1)[idx_r] * right_weights
+    return idx_l, idx_r, left_weights, right_weights, offset
+
+def sample_lines(img, sampler):
+    idx_l, idx_r, left_weights, right_weights, offset = sampler
+    img = img.reshape(-1)
+    return img[idx_l] * left_weights + img[idx_r] * right_weights - offset
+
+def sample_lines_block(frames, sampler, out = None):
+    # 一组原始帧 (n, h, w) 的采样，返回 (n, n_lines*len(shifts), ih)
+    if out is None:
+        out = np.empty((len(frames),) + sampler[0].shape)
+    if backend.use_numba():
+        backend.sample_lines_block(frames, sampler, out)
+    else:
+        for k, img in enumerate(frames):
+            out[k] = sample_lines(img, sampler)
+    return out
+
+def frame_to_line(img, fit, shifts = [0], verbose = 0, rotate = False):
+    lines = sample_lines(img, line_sampler(fit, shifts, img.shape, rotate))
     if verbose > 1:
         for line in lines:
             plt.plot(line)
         plt.show()
-    return np.array(lines)
-
-def reconstruct(reader, fit, shifts=[0]):
-    imgs = []
-    for img in reader:
-        lines = frame_to_line(img, fit, shifts = shifts, verbose = 0)
-        imgs.append(lines)
-    return np.transpose(np.array(imgs), (1,2,0))
+    return lines
+
+def line_roi(fit, shifts, rows, width):
+    # 重建用到的区域：rows=(y1, y2)范围内的行，谱线±偏移插值所需的列，返回竖直方向的 (y1, y2, x1, x2)
+    y1, y2 = rows
+    fit = np.reshape(fit, (-1, np.shape(fit)[-1]))[:, y1:y2]
+    x1 = int(np.clip(np.floor(np.min(fit) + min(shifts)), 0, width - 2))
+    x2 = int(np.clip(np.floor(np.max(fit) + max(shifts)) + 2, x1 + 2, width))
+    return y1, y2, x1, x2
+
+def reconstruct(reader, fit, shifts=[0], calibration=None, rows=None):
+    """
+    reconstruct 只读取谱线±偏移所在的列（以及rows范围内的行），重建图像
+    reconstruct reconstruct the images, reading only the columns around the line ± shifts (and the rows within rows)
+
+    :param fit: 谱线位置，(ih,) 或多条谱线 (n_lines, ih)，多条谱线在同一次读取中完成
+    :param fit: line positions, (ih,) or (n_lines, ih) to reconstruct several lines in the same pass
+    :param rows: 狭缝有光的范围 (y1, y2)，例如find_illuminated的结果；默认为全部行。范围外的行没有光，用每帧边缘几行的平均值填充
+    :param rows: illuminated range of the slit (y1, y2), e.g. from find_illuminated; all rows by default. The rows outside are dark, they are filled with the mean of the rows at the edge of the range in each frame
+    :return: (len(shifts), ih, frames)，或 (n_lines, len(shifts), ih, frames)
+    """
+    ih = reader.height
+    y1, y2, x1, x2 = line_roi(fit, shifts, (0, ih) if rows is None else rows, reader.width)
+    if reader.zero_copy:
+        # 帧是文件/内存的视图，按索引采样本身只访问ROI内的内存页，不需要裁剪
+        roi = reader
+        sampler = tuple(np.ascontiguousarray(v[:, y1:y2]) for v in line_sampler(fit, shifts, (reader._height, reader._width), reader.rotate, calibration))
+    else:
+        # 读取时需要转换的帧，只转换ROI内的像素
+        roi = reader.crop(y1, y2, x1, x2)
+        dark, gain = calibration_frames(calibration, (reader._height, reader._width))
+        if calibration is not None:
+            calibration = {'dark': None if dark is None else dark[roi.native_roi], 'gain': None if gain is None else gain[roi.native_roi]}
+        sampler = line_sampler(np.asarray(fit)[..., y1:y2] - x1, shifts, (roi._height, roi._width), roi.rotate, calibration)
+    imgs = np.empty((reader.frames, len(sampler[0]), ih))
+    for i, frames in roi.frame_blocks():
+        sample_lines_block(frames, sampler, imgs[i:i+len(frames), :, y1:y2])
+    # 范围外的行没有光，用同一帧中范围边缘（同样是暗行）的背景填充
+    m = min(4, y2 - y1)
+    if y1 > 0:
+        imgs[:, :, :y1] = np.mean(imgs[:, :, y1:y1+m], axis=2, keepdims=True)
+    if y2 < ih:
+        imgs[:, :, y2:] = np.mean(imgs[:, :, y2-m:y2], axis=2, keepdims=True)
+    if np.ndim(fit) == 2:
+        imgs = np.reshape(imgs, (reader.frames, len(fit), len(shifts), ih))
+        return np.transpose(imgs, (1,2,3,0))
+    return np.transpose(imgs, (1,2,0))
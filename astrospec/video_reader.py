@@ -5,29 +5,77 @@
 references:
 1. SER file definition: https://free-astro.org/index.php?title=File:SER_Doc_V3b.pdf
 2. https://github.com/thelondonsmiths/Solex_ser_recon_EN/blob/main/video_reader.py
+3. AVI RIFF file reference: https://learn.microsoft.com/en-us/windows/win32/directshow/avi-riff-file-reference
 """
+import os
 import numpy as np
 import mmap
 from .utils import print
 
+def to_native(frames):
+    # vectorized byte swap of a whole block, only for data not in the machine byte order
+    if frames.dtype.isnative:
+        return frames
+    return frames.astype(frames.dtype.newbyteorder('='))
+
 class video_reader:
-    def __init__(self, file, auto_rotate_vertical = False):
-        self.f = open(file, "r+b")
-        self.mm = mmap.mmap(self.f.fileno(), 0)
+    # frame source protocol: _width, _height, frames, get_frame(i) returning a (_height, _width) array (a view, possibly in the file byte order)
+    # zero_copy: get_frames returns contiguous views without converting the pixels
+    zero_copy = False
+    # per frame capture times (100ns ticks), if the source has them
+    timestamps = None
+
+    def __init__(self, auto_rotate_vertical = False):
         self.auto_rotate_vertical = auto_rotate_vertical
 
+    @staticmethod
+    def open(source, *args, **kwargs):
+        # path, file-like object, buffer, np.array (n, h, w), iterable of frames, or an existing reader
+        if isinstance(source, video_reader):
+            return source
+        if isinstance(source, (str, os.PathLike, bytes, bytearray, memoryview, mmap.mmap)) or hasattr(source, 'read'):
+            return video_reader.from_file(source, *args, **kwargs)
+        if isinstance(source, np.ndarray):
+            return video_reader.from_array(source, *args, **kwargs)
+        return video_reader.from_frames(source, *args, **kwargs)
+
     @staticmethod
     def from_file(file, *args, **kwargs):
-        if file.split('.')[-1].lower() == 'ser':
+        if isinstance(file, (str, os.PathLike)):
+            ext = os.fspath(file).split('.')[-1].lower()
+        else:
+            # file-like object or buffer, detect the type from its content
+            buf = video_reader_file.to_buffer(file)
+            ext = 'avi' if bytes(buf[0:4]) == b'RIFF' and bytes(buf[8:12]) == b'AVI ' else 'ser'
+            file = buf
+        if ext == 'ser':
             obj = video_reader_ser(file, *args, **kwargs)
+        elif ext == 'avi':
+            obj = video_reader_avi(file, *args, **kwargs)
         else:
             raise Exception('unsupportted input file type')
-        if obj.auto_rotate_vertical:
-            obj.rotate = obj._width > obj._height
-        else:
-            obj.rotate = False
         return obj
 
+    @staticmethod
+    def from_array(frames, *args, **kwargs):
+        return video_reader_array(frames, *args, **kwargs)
+
+    @staticmethod
+    def from_frames(frames, *args, **kwargs):
+        # iterators / generators can only be consumed once, keep the frames in memory for the later passes
+        return video_reader_array(list(frames), *args, **kwargs)
+
+    @staticmethod
+    def from_buffer(buffer, width, height, dtype = np.uint16, offset = 0, frames = None, *args, **kwargs):
+        # raw pixel buffer without header
+        frames = -1 if frames is None else frames * width * height
+        arr = np.frombuffer(buffer, dtype = dtype, count = frames, offset = offset)
+        return video_reader_array(arr.reshape(-1, height, width), *args, **kwargs)
+
+    @property
+    def rotate(self):
+        return self.auto_rotate_vertical and self._width > self._height
+
     @property
     def width(self):
         return self._width if not self.rotate else self._height
@@ -35,14 +83,41 @@ class video_reader:
     @property
     def height(self):
         return self._height if not self.rotate else self._width
-    
+
+    def get_frames(self, i, j):
+        # blocks are always in the machine byte order
+        return to_native(np.stack([self.get_frame(k) for k in range(i, j)]))
+
+    def dropped_frames(self, tolerance = 1.5):
+        # [(i, estimated number of frames lost between frame i and i+1)], from the gaps in the timestamps
+        if self.timestamps is None or self.frames < 3:
+            return []
+        dt = np.diff(self.timestamps.astype(np.int64))
+        step = np.median(dt)
+        if step <= 0:
+            return []
+        return [(int(i), max(1, int(round(dt[i] / step)) - 1)) for i in np.nonzero(dt > step * tolerance)[0]]
+
+    def subset(self, indices):
+        # reader over the given frames only, e.g. every n-th frame for a quick look
+        return video_reader_subset(self, indices)
+
+    def crop(self, y1, y2, x1, x2):
+        # reader over a region of interest, rows y1:y2 and columns x1:x2 in the vertical layout
+        return video_reader_crop(self, y1, y2, x1, x2)
+
+    def frame_blocks(self, block_size = 64):
+        # (first frame index, native frames (n, _height, _width)) blocks
+        for i in range(0, self.frames, block_size):
+            yield i, self.get_frames(i, min(self.frames, i + block_size))
+
     def __iter__(self):
         self.i = 0
         return self
 
     def __next__(self):
         if self.i < self.frames:
-            img = self.get_frame(self.i)
+            img = to_native(self.get_frame(self.i))
             if self.rotate:
                 img = np.rot90(img)
             self.i += 1
@@ -50,51 +125,275 @@ class video_reader:
         else:
             raise StopIteration
 
-class video_reader_ser(video_reader):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+class video_reader_array(video_reader):
+    def __init__(self, frames, auto_rotate_vertical = False):
+        super().__init__(auto_rotate_vertical)
+        if len(frames) == 0:
+            raise Exception('no frames')
+        self._frames = frames
+        self._height, self._width = np.shape(frames[0])
+        if np.dtype(frames[0].dtype).kind not in 'uif':
+            raise Exception(f'unsupportted frame dtype ({frames[0].dtype}), expected unsigned, signed integer or float frames')
+        # blocks are converted to the machine byte order
+        self.dtype = frames[0].dtype.newbyteorder('=')
+        self.frames = len(frames)
+
+    @property
+    def zero_copy(self):
+        return isinstance(self._frames, np.ndarray) and self._frames.flags.c_contiguous and self._frames.dtype.isnative
+
+    def get_frame(self, i):
+        return self._frames[i]
+
+    def get_frames(self, i, j):
+        if isinstance(self._frames, np.ndarray):
+            return to_native(self._frames[i:j])
+        return super().get_frames(i, j)
+
+class video_reader_subset(video_reader):
+    def __init__(self, reader, indices):
+        super().__init__(reader.auto_rotate_vertical)
+        self.reader = reader
+        self.indices = np.asarray(indices, dtype=int)
+        self._width, self._height = reader._width, reader._height
+        self.dtype = reader.dtype
+        self.frames = len(self.indices)
+
+    @property
+    def rotate(self):
+        return self.reader.rotate
+
+    def get_frame(self, i):
+        return self.reader.get_frame(self.indices[i])
+
+class video_reader_crop(video_reader):
+    # the region is a rectangle in the native layout too, frames are views and only its pixels are read
+    def __init__(self, reader, y1, y2, x1, x2):
+        super().__init__(reader.auto_rotate_vertical)
+        self.reader = reader
+        if reader.rotate:
+            # np.rot90(img)[y, x] == img[x, nw-1-y]
+            nw = reader._width
+            self.native_roi = (slice(x1, x2), slice(nw - y2, nw - y1))
+        else:
+            self.native_roi = (slice(y1, y2), slice(x1, x2))
+        self._height = self.native_roi[0].stop - self.native_roi[0].start
+        self._width = self.native_roi[1].stop - self.native_roi[1].start
+        self.dtype = reader.dtype
+        self.frames = reader.frames
+
+    @property
+    def rotate(self):
+        return self.reader.rotate
+
+    def get_frame(self, i):
+        return self.reader.get_frame(i)[self.native_roi]
+
+    def get_frames(self, i, j):
+        if self.reader.zero_copy:
+            return self.reader.get_frames(i, j)[(slice(None),) + self.native_roi]
+        # only the region of each frame is converted and copied
+        return super().get_frames(i, j)
+
+class video_reader_file(video_reader):
+    def __init__(self, file, auto_rotate_vertical = False):
+        super().__init__(auto_rotate_vertical)
+        if isinstance(file, (str, os.PathLike)):
+            self.f = open(file, "rb")
+            file = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mm = video_reader_file.to_buffer(file)
+
+    @staticmethod
+    def to_buffer(file):
+        # zero-copy memoryview of a file-like object or buffer
+        if isinstance(file, memoryview):
+            return file
+        if isinstance(file, (bytes, bytearray, mmap.mmap)):
+            return memoryview(file)
+        if hasattr(file, 'getbuffer'):
+            return file.getbuffer()
+        try:
+            return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        except Exception:
+            return memoryview(file.read())
+
+    def uint(self, offset, sz = 4):
+        return int.from_bytes(self.mm[offset:offset+sz], byteorder='little', signed=False)
+
+class video_reader_ser(video_reader_file):
+    # mono, Bayer and RGB/BGR captures, 8~16 bits in either byte order
+    # colour data is read as a view of the single plane that carries the line (red for H-alpha by default), without demosaicing
+    zero_copy = True
+    # ColorID -> 2x2 Bayer cell in row-major order, or the planes of an RGB/BGR pixel
+    patterns = {0: None, 8: 'RGGB', 9: 'GRBG', 10: 'GBRG', 11: 'BGGR', 16: 'CYYM', 17: 'YCMY', 18: 'YMCY', 19: 'MYYC', 100: 'RGB', 101: 'BGR'}
+
+    def __init__(self, file, auto_rotate_vertical = False, channel = 'R', byteorder = None):
+        super().__init__(file, auto_rotate_vertical)
         offset = 0
 
         sz = 14
-        self.fourcc = self.mm[offset:offset+sz]
+        self.fourcc = bytes(self.mm[offset:offset+sz])
         offset += sz
         sz = 4
-        self.lu_id = int.from_bytes(self.mm[offset:offset+sz], byteorder='little', signed=False)
+        self.lu_id = self.uint(offset, sz)
         offset += sz
         sz = 4
-        self.color_id = int.from_bytes(self.mm[offset:offset+sz], byteorder='little', signed=False)
+        self.color_id = self.uint(offset, sz)
         offset += sz
         sz = 4
-        self.little_endian = int.from_bytes(self.mm[offset:offset+sz], byteorder='little', signed=False)
+        self.little_endian = self.uint(offset, sz)
         offset += sz
         sz = 4
-        self._width = int.from_bytes(self.mm[offset:offset+sz], byteorder='little', signed=False)
+        self._width = self.uint(offset, sz)
         offset += sz
         sz = 4
-        self._height = int.from_bytes(self.mm[offset:offset+sz], byteorder='little', signed=False)
+        self._height = self.uint(offset, sz)
         offset += sz
         sz = 4
-        self.depth = int.from_bytes(self.mm[offset:offset+sz], byteorder='little', signed=False)
+        self.depth = self.uint(offset, sz)
         offset += sz
         sz = 4
-        self.frames = int.from_bytes(self.mm[offset:offset+sz], byteorder='little', signed=False)
+        self.frames = self.uint(offset, sz)
         offset += sz
 
-        if self.depth == 8:
+        # depth is the number of significant bits, 9~16 bits are stored in 2 bytes
+        if 0 < self.depth <= 8:
             self.dtype = np.uint8
-        elif self.depth == 16:
+        elif 8 < self.depth <= 16:
             self.dtype = np.uint16
         elif self.depth == 32:
             self.dtype = np.uint32
         else:
             raise Exception(f'unsupportted depth ({self.depth})')
-        self.frame_size = self._width * self._height * self.depth // 8
+        if self.color_id not in self.patterns:
+            raise Exception(f'unsupportted color id ({self.color_id})')
+        self.pattern = self.patterns[self.color_id]
+        self.planes = 3 if self.color_id >= 100 else 1
+        self.sensor_shape = (self._height, self._width) + ((3,) if self.planes == 3 else ())
+        self.frame_size = self._width * self._height * self.planes * np.dtype(self.dtype).itemsize
         self.offset = 178
 
+        # plane of the colour channel, as an index into the (h, w) or (h, w, 3) frame
+        self.plane = ()
+        if self.pattern is not None:
+            c = channel if isinstance(channel, int) else self.pattern.find(str(channel).upper())
+            if not 0 <= c < len(self.pattern):
+                raise Exception(f'channel {channel} is not in the colour pattern {self.pattern}')
+            if self.planes == 3:
+                self.plane = (slice(None), slice(None), c)
+            else:
+                dy, dx = divmod(c, 2)
+                self._height, self._width = self._height // 2, self._width // 2
+                self.plane = (slice(dy, dy + self._height * 2, 2), slice(dx, dx + self._width * 2, 2))
+        self.channel = channel
+
+        # the specification says LittleEndian = 0 is big-endian, but the capture softwares write 0 for little-endian data,
+        # follow them and check the data when it is ambiguous
+        if byteorder is None:
+            byteorder = '<' if self.little_endian == 0 else '>'
+            if np.dtype(self.dtype).itemsize == 2 and self.frames > 0:
+                byteorder = self.check_byteorder(byteorder)
+        self.file_dtype = np.dtype(self.dtype).newbyteorder(byteorder)
+        # strided colour planes and swapped pixels are not contiguous views, readers crop them before converting
+        self.zero_copy = self.plane == () and self.file_dtype.isnative
+        self.timestamps = self.read_timestamps()
+
         # print(self.fourcc, self.lu_id, self.color_id, self.little_endian, self._width, self._height, self.depth, self.frames)
 
-    def get_frame(self, i):
+    def check_byteorder(self, byteorder):
+        # pixels read in the wrong byte order are noise: swap if the other order is much smoother along the rows
+        img = self.raw_frames(self.frames // 2, self.frames // 2 + 1, np.dtype(self.dtype).newbyteorder(byteorder))[0]
+        other = '>' if byteorder == '<' else '<'
+        roughness = [np.mean(np.abs(np.diff(img.view(order + 'u2').astype(np.int32), axis=1))) for order in (byteorder, other)]
+        if roughness[1] * 4 < roughness[0]:
+            print(f'LittleEndian = {self.little_endian} does not match the data, read as {"little" if other == "<" else "big"}-endian')
+            return other
+        return byteorder
+
+    def raw_frames(self, i, j, dtype = None):
+        # frames i:j as a view of the file, (n, h, w) or (n, h, w, 3) in the file byte order
+        dtype = self.file_dtype if dtype is None else dtype
         offset = self.offset + i * self.frame_size
-        img = np.frombuffer(self.mm[offset:offset+self.frame_size], dtype=self.dtype)
-        img = np.reshape(img, (self._height, self._width))
+        imgs = np.frombuffer(self.mm, dtype=dtype, count=(j - i) * self.frame_size // dtype.itemsize, offset=offset)
+        return np.reshape(imgs, (j - i,) + self.sensor_shape)
+
+    def read_timestamps(self):
+        # trailer: one 64-bit timestamp per frame (100ns ticks since 0001-01-01 UTC), read in one go; all zeros if not recorded
+        offset = self.offset + self.frames * self.frame_size
+        if self.frames == 0 or len(self.mm) < offset + 8 * self.frames:
+            return None
+        timestamps = np.frombuffer(self.mm, dtype='<u8', count=self.frames, offset=offset)
+        return timestamps if np.any(timestamps) else None
+
+    def get_frame(self, i):
+        return self.raw_frames(i, i + 1)[(0,) + self.plane]
+
+    def get_frames(self, i, j):
+        # consecutive frames are contiguous in the file, zero-copy for mono data in the machine byte order;
+        # otherwise only the plane of the block is swapped
+        return to_native(self.raw_frames(i, j)[(slice(None),) + self.plane])
+
+class video_reader_avi(video_reader_file):
+    # uncompressed AVI (8-bit gray or 24-bit BGR), including OpenDML (AVIX) files larger than 1GB
+    def __init__(self, file, auto_rotate_vertical = False, channel = 2):
+        super().__init__(file, auto_rotate_vertical)
+        self.channel = channel
+        self.bottom_up = True
+        self.depth = None
+        self.frame_offsets = []
+
+        size = len(self.mm)
+        offset = 0
+        while offset + 12 <= size:
+            if bytes(self.mm[offset:offset+4]) != b'RIFF':
+                break
+            sz = self.uint(offset + 4)
+            self.parse_list(offset + 12, min(size, offset + 8 + sz))
+            offset += 8 + sz + (sz & 1)
+
+        if self.depth is None:
+            raise Exception('no video stream found')
+        if self.depth == 8:
+            self.pixel_size = 1
+        elif self.depth == 24:
+            self.pixel_size = 3
+        else:
+            raise Exception(f'unsupportted depth ({self.depth})')
+        # rows are padded to 4 bytes
+        self.stride = (self._width * self.pixel_size + 3) // 4 * 4
+        self.frame_size = self.stride * self._height
+        self.frame_offsets = [offset for offset, sz in self.frame_offsets if sz == self.frame_size]
+        self.frames = len(self.frame_offsets)
+        self.dtype = np.uint8
+
+    def parse_list(self, offset, end):
+        while offset + 8 <= end:
+            fourcc = bytes(self.mm[offset:offset+4])
+            sz = self.uint(offset + 4)
+            data = offset + 8
+            if fourcc == b'LIST':
+                self.parse_list(data + 4, data + sz)
+            elif fourcc == b'strf' and self.depth is None:
+                # BITMAPINFOHEADER
+                self._width = self.uint(data + 4)
+                height = int.from_bytes(self.mm[data+8:data+12], byteorder='little', signed=True)
+                self._height = abs(height)
+                self.depth = self.uint(data + 14, 2)
+                compression = bytes(self.mm[data+16:data+20])
+                if compression not in (b'\x00\x00\x00\x00', b'Y800', b'GREY', b'Y8  '):
+                    raise Exception(f'unsupportted compression ({compression})')
+                # only BI_RGB bitmaps are bottom-up for a positive height, YUV formats (Y800 etc.) are always top-down
+                self.bottom_up = height > 0 and compression == b'\x00\x00\x00\x00'
+            elif fourcc[2:] in (b'db', b'dc'):
+                self.frame_offsets.append((data, sz))
+            offset = data + sz + (sz & 1)
+
+    def get_frame(self, i):
+        img = np.frombuffer(self.mm, dtype=np.uint8, count=self.frame_size, offset=self.frame_offsets[i])
+        img = np.reshape(img, (self._height, self.stride))
+        img = img[:, :self._width * self.pixel_size]
+        if self.pixel_size == 3:
+            img = np.reshape(img, (self._height, self._width, 3))[:, :, self.channel]
+        if self.bottom_up:
+            img = img[::-1]
         return img
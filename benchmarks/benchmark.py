@@ -0,0 +1,164 @@
+"""
+@author: Harold Liang (https://lcsky.org)
+
+micro benchmarks of the hot kernels, run with: python benchmarks/benchmark.py
+"""
+
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from astrospec import backend
+from astrospec.spectrum import line_sampler, sample_lines, sample_lines_block, fit_parabola_rows, reduce_mean, reconstruct
+from astrospec.video_reader import video_reader
+from astrospec.shape_correction import detect_edge_points
+from astrospec.light_correction import find_rising
+from astrospec.quality import _sharpness
+
+def timeit(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+def frames_to_lines_rot90(frames, fit, shifts):
+    # 旧实现：逐帧np.rot90后按行花式索引
+    ret = []
+    for img in frames:
+        img = np.rot90(img) if img.shape[1] > img.shape[0] else img
+        ih, iw = img.shape
+        lines = []
+        for shift in shifts:
+            fit_with_shift = fit + shift
+            idx_l = np.clip(fit_with_shift.astype(int), 0, iw - 2)
+            right_weights = fit_with_shift - fit_with_shift.astype(int)
+            value = img[np.arange(ih), idx_l] * (1 - right_weights) + img[np.arange(ih), idx_l + 1] * right_weights
+            lines.append(value)
+        ret.append(lines)
+    return np.array(ret)
+
+def frames_to_lines_native(frames, fit, shifts):
+    rotate = frames.shape[2] > frames.shape[1]
+    sampler = line_sampler(fit, shifts, frames.shape[1:], rotate)
+    ret = np.empty((len(frames), len(shifts), len(fit)))
+    for i, img in enumerate(frames):
+        ret[i] = sample_lines(img, sampler)
+    return ret
+
+def mean_rot90(frames):
+    imgs = np.zeros(np.rot90(frames[0]).shape, dtype='uint64')
+    for img in frames:
+        imgs += np.rot90(img)
+    return imgs
+
+def mean_native(frames):
+    imgs = np.zeros(frames.shape[1:], dtype='uint64')
+    for img in frames:
+        imgs += img
+    return np.rot90(imgs)
+
+def bench_layout(n=200, slit=2048, spec=256, shifts=[-1, 0, 1]):
+    fit = spec / 2 + 20 * np.sin(np.linspace(0, 3, slit))
+    for name, shape in [('landscape', (n, spec, slit)), ('portrait', (n, slit, spec))]:
+        frames = np.random.randint(0, 65535, shape, dtype=np.uint16)
+        a = frames_to_lines_rot90(frames, fit, shifts)
+        b = frames_to_lines_native(frames, fit, shifts)
+        assert np.allclose(a, b)
+        t0 = timeit(lambda: frames_to_lines_rot90(frames, fit, shifts))
+        t1 = timeit(lambda: frames_to_lines_native(frames, fit, shifts))
+        print(f'frame_to_line {name:9s} {shape}: rot90 {t0*1000:8.2f} ms, native {t1*1000:8.2f} ms, speedup {t0/t1:5.2f}x')
+        if name == 'landscape':
+            assert np.array_equal(mean_rot90(frames), mean_native(frames))
+            t0 = timeit(lambda: mean_rot90(frames))
+            t1 = timeit(lambda: mean_native(frames))
+            print(f'reduce_mean   {name:9s} {shape}: rot90 {t0*1000:8.2f} ms, native {t1*1000:8.2f} ms, speedup {t0/t1:5.2f}x')
+
+def reconstruct_frames(reader, fit, shifts):
+    # 旧实现：整帧读取（转换）后采样
+    sampler = line_sampler(fit, shifts, (reader._height, reader._width), reader.rotate)
+    imgs = np.empty((reader.frames, len(shifts), reader.height))
+    for i, frames in reader.frame_blocks():
+        sample_lines_block(frames, sampler, imgs[i:i+len(frames)])
+    return np.transpose(imgs, (1, 2, 0))
+
+def bench_roi(n=200, slit=2048, spec=256, shifts=[-1, 0, 1]):
+    # 读取时需要转换的帧（此处为帧列表，每块需要拼接）只转换谱线附近的列；reduce_mean按块uint32求和，与逐帧uint64累加比较
+    fit = spec / 2 + 20 * np.sin(np.linspace(0, 3, slit))
+    frames = np.random.randint(0, 65535, (n, spec, slit), dtype=np.uint16)
+    reader = video_reader.from_frames(frames, auto_rotate_vertical=True)
+    assert np.array_equal(reconstruct_frames(reader, fit, shifts), reconstruct(reader, fit, shifts))
+    t0 = timeit(lambda: reconstruct_frames(reader, fit, shifts))
+    t1 = timeit(lambda: reconstruct(reader, fit, shifts))
+    print(f'reconstruct   roi       {frames.shape}: frame {t0*1000:8.2f} ms, roi    {t1*1000:8.2f} ms, speedup {t0/t1:5.2f}x')
+    reader = video_reader.from_array(frames, auto_rotate_vertical=True)
+    assert np.array_equal(mean_native(frames) / n, reduce_mean(reader, dtype='float64'))
+    t0 = timeit(lambda: mean_native(frames))
+    t1 = timeit(lambda: reduce_mean(reader, dtype='float64'))
+    print(f'reduce_mean   blocks    {frames.shape}: frame {t0*1000:8.2f} ms, blocks {t1*1000:8.2f} ms, speedup {t0/t1:5.2f}x')
+
+def compare_backends(name, func, check):
+    # 同一函数分别在numpy（参考实现）和numba后端下运行，检查一致性并比较速度
+    backend.set_backend('numpy')
+    a = func()
+    t0 = timeit(func)
+    backend.set_backend('numba')
+    b = func()
+    assert check(a, b), f'{name}: numba result differs from numpy'
+    t1 = timeit(func)
+    print(f'{name:28s}: numpy {t0*1000:8.2f} ms, numba {t1*1000:8.2f} ms, speedup {t0/t1:6.2f}x, parity ok')
+
+def bench_backend(n=200, slit=2048, spec=256, shifts=[-1, 0, 1]):
+    if backend.numba is None:
+        print('numba is not installed, skip backend benchmark')
+        return
+    fit = spec / 2 + 20 * np.sin(np.linspace(0, 3, slit))
+    frames = np.random.randint(0, 65535, (n, spec, slit), dtype=np.uint16)
+    sampler = line_sampler(fit, shifts, frames.shape[1:], True)
+    compare_backends('sample_lines_block', lambda: sample_lines_block(frames, sampler), np.allclose)
+
+    x = np.arange(slit)
+    frames[:, :, (x < slit * 0.2) | (x > slit * 0.8)] //= 16
+    reader = video_reader.from_array(frames, auto_rotate_vertical=True)
+    compare_backends('detect_edge_points', lambda: detect_edge_points(reader, fit), lambda a, b: all(np.allclose(x, y, equal_nan=True) for x, y in zip(a, b)))
+
+    img = np.random.randint(1000, 2000, (slit, spec)).astype(np.uint16)
+    img[:, spec//2-3:spec//2+4] = [1500, 1100, 700, 600, 650, 1000, 1400]
+    x_ymins_int = np.argmin(img, axis=1)
+    compare_backends('fit_parabola_rows', lambda: fit_parabola_rows(img, x_ymins_int, 0, slit, 0, spec, 2) if backend.get_backend() == 'numpy' else backend.fit_parabola_rows(img, x_ymins_int, 0, slit, 0, spec, 2), np.allclose)
+    # 小整数的随机窗口中有平坦与共线（没有极值）的行
+    img = np.random.randint(0, 4, (slit, spec)).astype(np.uint16)
+    img[:8, spec//2-3:spec//2+4] = 7
+    img[8:16, spec//2-3:spec//2+4] = np.arange(7) * 3
+    x_ymins_int = np.argmin(img, axis=1)
+    x_ymins_int[:16] = spec // 2
+    compare_backends('fit_parabola_rows degenerate', lambda: fit_parabola_rows(img, x_ymins_int, 0, slit, 0, spec, 2) if backend.get_backend() == 'numpy' else backend.fit_parabola_rows(img, x_ymins_int, 0, slit, 0, spec, 2), np.allclose)
+
+    curve = np.concatenate([np.random.normal(100, 5, slit // 3), np.full(slit - slit // 3, 1000.0)])
+    compare_backends('find_rising', lambda: find_rising(curve), lambda a, b: a == b)
+    backend.set_backend('auto')
+
+def check_sharpness(h=600, w=134, trials=10):
+    # 清晰度得分：增加噪声（方差沿狭缝变化，与亮度相关）不会提高得分，纯噪声得分为0
+    rng = np.random.default_rng(0)
+    ellipse = ((w / 2, h / 2), w / 2 * 0.95, h / 2 * 0.95, 0)
+    kernel = np.exp(-np.arange(-9, 10) ** 2 / 18)
+    texture = np.apply_along_axis(lambda c: np.convolve(c, kernel / np.sum(kernel), 'same'), 0, rng.standard_normal((h, w)))
+    img = 3000 * (1 + 0.05 * texture)
+    profile = np.linspace(0.5, 1, h)[:, None]
+    clean = _sharpness(img, ellipse)
+    for k in [1, 2, 4, 8, 16]:
+        scores = [_sharpness(img + rng.standard_normal(img.shape) * np.sqrt(profile * img) * k, ellipse) for _ in range(trials)]
+        assert max(scores) <= clean, f'sharpness: noise x{k} scores {max(scores):.4f} > {clean:.4f}'
+    scores = [_sharpness(1000 + rng.standard_normal(img.shape) * np.sqrt(profile) * 50, ellipse) for _ in range(trials)]
+    assert max(scores) == 0, f'sharpness: white noise scores {max(scores):.4f}'
+    print(f'sharpness: clean {clean:.4f}, noisy scans never score higher, white noise scores 0')
+
+if __name__ == "__main__":
+    bench_layout()
+    bench_roi()
+    bench_backend()
+    check_sharpness()
@@ -15,6 +15,9 @@ setup(
         "opencv_python~=4.6.0.66",
         "tqdm~=4.63.0"
     ],
+    extras_require={
+        "jit": ["numba"],
+    },
     entry_points = {
         'console_scripts': [
             'ascli = astrospec.cli:main',                  